@@ -1,6 +1,7 @@
 # Importações necessárias
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from supabase import create_client
+from postgrest.exceptions import APIError
 import os
 from dotenv import load_dotenv
 from flask_jwt_extended import (
@@ -9,27 +10,49 @@ from flask_jwt_extended import (
     get_jwt_identity,
     create_access_token
 )
+from jwt import ExpiredSignatureError, decode as decode_jwt, encode as encode_jwt
 import uuid
 from math import radians, sin, cos, sqrt, atan2
 from flask_cors import CORS
-from datetime import datetime, timezone # Importa timezone
-import traceback 
-import paho.mqtt.client as mqtt
-import ssl
-import json
+from datetime import datetime, timedelta, timezone # Importa timezone
+import logging
 from flask_apscheduler import APScheduler
+import atexit
+import time
+import json
+import base64
+import hashlib
+import hmac
+import math
+import re
+import socket
+import sys
+import threading
+from concurrent.futures import wait
+from mqtt_publisher import MqttPublisher
+from release_scheduler import ReleaseScheduler, parse_release_date
+from spatial_index import SpatialIndex
+from cache import TTLCache, ReadThroughCache, create_cache_backend
+from events import create_event_broker, event_time
+from metrics import (REGISTRY, Counter, Gauge, Histogram, InstrumentedSupabase, MultiProcessCollector,
+                     configure_logging)
 
 # Carrega variáveis de ambiente do arquivo .env
 load_dotenv()
 
+# Logs estruturados (uma linha JSON por evento)
+configure_logging(os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger('time_capsule')
+
 # Inicializa a aplicação Flask
 app = Flask(__name__)
+CORS_ORIGINS = [
+    "https://time-capsule20.vercel.app",
+    "http://localhost:5173"
+]
 CORS(app, resources={
     r"/*": {
-        "origins": [
-            "https://time-capsule20.vercel.app",
-            "http://localhost:5173"
-        ],
+        "origins": CORS_ORIGINS,
         "methods": ["GET", "POST", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
         "supports_credentials": True,
@@ -41,120 +64,574 @@ CORS(app, resources={
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
 jwt = JWTManager(app)
 
-# Inicializa o cliente Supabase
-supabase = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
+# Inicializa o cliente Supabase (cada chamada é cronometrada por tabela/bucket e operação)
+supabase = InstrumentedSupabase(create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY')))
+
+# --- MÉTRICAS (expostas em /metrics) ---
+
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Duração das requisições HTTP",
+                         ("method", "route", "status"))
+MQTT_PUBLISH_LATENCY = Histogram("mqtt_publish_duration_seconds",
+                                 "Tempo entre enfileirar uma publicação MQTT e receber o PUBACK")
+MQTT_PUBLISH_FAILURES = Counter("mqtt_publish_failures_total", "Publicações MQTT sem confirmação")
+SCHEDULER_JOB_DURATION = Histogram("scheduler_job_duration_seconds",
+                                   "Duração dos jobs do agendador", ("job",),
+                                   buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+RELEASE_LAG = Histogram("release_lag_seconds",
+                        "Atraso entre a release_date e o início da liberação de cada cápsula física",
+                        buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900))
+RELEASE_BATCH_SIZE = Histogram("release_batch_size", "Cápsulas por lote de liberação",
+                               buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000))
+
+# Cada worker do gunicorn tem o próprio registro; com PROMETHEUS_MULTIPROC_DIR
+# o /metrics de qualquer um deles soma os de todos (ver MultiProcessCollector)
+METRICS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+metrics_collector = MultiProcessCollector(REGISTRY, METRICS_MULTIPROC_DIR) if METRICS_MULTIPROC_DIR else None
+if metrics_collector is not None:
+    metrics_collector.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_LATENCY.observe(time.perf_counter() - start, request.method, route, response.status_code)
+    return response
+
+# Cache de leitura das cápsulas (por usuário e por cápsula). Desativado por
+# padrão; com vários workers, só CACHE_URL=redis://... mantém as invalidações
+# válidas para todos (CACHE_URL=memory serve apenas a um único processo).
+capsule_cache = ReadThroughCache(create_cache_backend(
+    os.getenv('CACHE_URL'),
+    ttl=int(os.getenv('CACHE_TTL', 60)),
+    maxsize=int(os.getenv('CACHE_MAXSIZE', 10000))
+))
+
+# Eventos em tempo real (GET /capsules/events). Com a liberação em outro processo,
+# use EVENTS_URL=redis://... para que os eventos cheguem aos workers web.
+EVENTS_BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', 10000))      # eventos guardados para retomada
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', 256))          # eventos pendentes por conexão
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv('EVENTS_HEARTBEAT_SECONDS', 15))
+# No modo WSGI cada stream prende um worker/thread pela duração da conexão; o
+# worker sync do gunicorn (padrão) ainda é morto pelo `timeout`. Só habilite
+# com um worker próprio para conexões longas (gthread, gevent, eventlet).
+EVENTS_WSGI = os.getenv('EVENTS_WSGI', '0') == '1'
+# O EventSource não envia cabeçalhos, então o token vai na URL (e nos logs de
+# acesso e de proxies): por isso a conexão usa um token curto e exclusivo do
+# stream, emitido por POST /capsules/events/token, e nunca o JWT de acesso.
+EVENTS_TOKEN_TTL = int(os.getenv('EVENTS_TOKEN_TTL', 60))
+EVENTS_TOKEN_AUDIENCE = 'capsule-events'
+event_broker = create_event_broker(os.getenv('EVENTS_URL'), buffer_size=EVENTS_BUFFER_SIZE,
+                                   queue_size=EVENTS_QUEUE_SIZE)
 
 # --- CÓDIGO MQTT E AGENDADOR ---
 
-# Credenciais do HiveMQ
-MQTT_BROKER_URL = "06bcdf1d27ac416eaeee25f7ba3f6331.s1.eu.hivemq.cloud"
-MQTT_PORT = 8883
-MQTT_USER = "Univesp_pji6"
-MQTT_PASSWORD = "Admin_pji6"
-MQTT_TOPIC = "capsulatempo/expira/cps-001"
+# Credenciais do HiveMQ (podem ser sobrescritas para testar contra um broker local, ex.: mosquitto)
+MQTT_BROKER_URL = os.getenv('MQTT_BROKER_URL', "06bcdf1d27ac416eaeee25f7ba3f6331.s1.eu.hivemq.cloud")
+MQTT_PORT = int(os.getenv('MQTT_PORT', 8883))
+MQTT_USER = os.getenv('MQTT_USER', "Univesp_pji6")
+MQTT_PASSWORD = os.getenv('MQTT_PASSWORD', "Admin_pji6")
+MQTT_TOPIC = os.getenv('MQTT_TOPIC', "capsulatempo/expira/cps-001")
+MQTT_TLS = os.getenv('MQTT_TLS', '1') != '0'
+MQTT_ACK_TIMEOUT = float(os.getenv('MQTT_ACK_TIMEOUT', 30))
+
+# Sessão MQTT única e persistente, compartilhada por todas as publicações
+mqtt_publisher = MqttPublisher(
+    MQTT_BROKER_URL, MQTT_PORT,
+    username=MQTT_USER, password=MQTT_PASSWORD,
+    topic=MQTT_TOPIC, tls=MQTT_TLS,
+    ack_timeout=MQTT_ACK_TIMEOUT
+)
 
 # Configuração do Agendador
 scheduler = APScheduler()
 scheduler.init_app(app)
-scheduler.start()
 
-# [A CORREÇÃO ESTÁ AQUI]
+# Onde as cápsulas físicas são liberadas:
+#   embedded - índice em memória neste processo (uma única instância com um worker)
+#   claim    - cada processo reivindica as cápsulas vencidas com reserva (lease) no
+#              banco (sql/claim_due_capsules.sql); seguro com vários workers/instâncias
+#   off      - este processo não libera nada (use scheduler_worker.py à parte)
+SCHEDULER_MODES = ('embedded', 'claim', 'off')
+SCHEDULER_MODE = os.getenv('SCHEDULER_MODE', 'embedded')
+if SCHEDULER_MODE not in SCHEDULER_MODES:
+    raise ValueError(f"SCHEDULER_MODE deve ser um de: {', '.join(SCHEDULER_MODES)}")
+
+WEB_SERVERS = ('gunicorn', 'uvicorn', 'hypercorn')
+
+def web_worker_count():
+    """
+    Número de workers do servidor web que carregou o app, lido de `-w`/`--workers`
+    na linha de comando ou de WEB_CONCURRENCY (padrão do gunicorn e do uvicorn).
+    Retorna 1 fora de um desses servidores ou se não der para saber (ex.: workers
+    definidos em arquivo de configuração).
+    """
+    if not any(server in sys.argv[0] for server in WEB_SERVERS):
+        return 1
+    workers = os.getenv('WEB_CONCURRENCY', '1')
+    args = sys.argv[1:]
+    for i, arg in enumerate(args):
+        if arg in ('-w', '--workers') and i + 1 < len(args):
+            workers = args[i + 1]
+        elif arg.startswith('--workers='):
+            workers = arg.split('=', 1)[1]
+        elif arg.startswith('-w') and arg[2:].isdigit():
+            workers = arg[2:]
+    try:
+        return int(workers)
+    except ValueError:
+        return 1
+
+# Com vários workers, cada um teria o próprio índice e publicaria cada cápsula física de novo
+if SCHEDULER_MODE == 'embedded' and web_worker_count() > 1:
+    raise ValueError("SCHEDULER_MODE=embedded só funciona com um worker; com vários, use "
+                     "SCHEDULER_MODE=claim ou SCHEDULER_MODE=off com scheduler_worker.py")
+
+def publish_mqtt(payload_json):
+    """ Enfileira uma publicação no publicador persistente, medindo a latência até o PUBACK. """
+    start = time.perf_counter()
+    future = mqtt_publisher.publish(payload_json)
+
+    def record(done):
+        if not done.cancelled() and done.exception() is None:
+            MQTT_PUBLISH_LATENCY.observe(time.perf_counter() - start)
+        else:
+            MQTT_PUBLISH_FAILURES.inc()
+    future.add_done_callback(record)
+    return future
+
 def publish_to_mqtt(payload_json):
     """
-    Conecta-se ao broker HiveMQ via TLS e publica uma mensagem.
-    Compatível com Paho MQTT v2.x (Sintaxe Corrigida)
+    Publica uma mensagem pela sessão MQTT persistente e espera a confirmação (QoS 1).
+    Retorna True se o broker confirmou o recebimento.
     """
+    future = publish_mqtt(payload_json)
     try:
-        # 1. Define transporte no construtor
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, transport="tcp")
-        
-        client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
-        
-        # 2. Configura TLS corretamente (sem o 'transport')
-        client.tls_set(tls_version=ssl.PROTOCOL_TLSv1_2)
-        client.tls_insecure_set(False)
-        
-        print(f"Tentando conectar ao broker MQTT (v2): {MQTT_BROKER_URL}...")
-        client.connect(MQTT_BROKER_URL, MQTT_PORT, 60)
-        
-        client.loop_start()  # 3. Inicia o loop de rede ANTES de publicar
-        
-        # 4. Publica com QoS 1 para garantir entrega
-        result = client.publish(MQTT_TOPIC, json.dumps(payload_json), qos=1)
-        result.wait_for_publish()  # 5. Espera a confirmação do envio
-        
-        client.disconnect()
-        client.loop_stop()
-        
-        print(f"Mensagem publicada com sucesso no tópico: {MQTT_TOPIC}")
+        future.result(timeout=MQTT_ACK_TIMEOUT)
+        logger.info("Mensagem MQTT publicada", extra={"topic": MQTT_TOPIC})
         return True
-
     except Exception as e:
-        print(f"!!!!!! ERRO AO PUBLICAR NO MQTT (v2) !!!!!!")
-        traceback.print_exc()
+        future.cancel()  # Se ainda estiver na fila, não sai depois que desistimos
+        logger.error("Erro ao publicar no MQTT", extra={"topic": MQTT_TOPIC, "error": str(e)})
         return False
-# [FIM DA CORREÇÃO]
 
-def check_expired_capsules():
+def capsule_event_data(capsule):
+    return {"capsule_id": capsule['id'], "tipo": capsule.get('tipo'), "release_date": capsule['release_date']}
+
+def build_capsule_payload(capsule):
+    return {
+        "capsula": {
+            "id": str(capsule['id']),
+            "tipo": "fisica",
+            "tempo": { "abrir_em": capsule['release_date'] },
+            "conteudo": { "mensagem": capsule.get('message', 'Cápsula física pronta!') }
+        }
+    }
+
+# Processamento em lote das cápsulas vencidas
+RELEASE_PUBLISH_WINDOW = int(os.getenv('RELEASE_PUBLISH_WINDOW', 200))  # publicações simultâneas em voo
+RELEASE_UPDATE_CHUNK = int(os.getenv('RELEASE_UPDATE_CHUNK', 200))      # IDs por UPDATE ... in_()
+RELEASE_PAGE_SIZE = int(os.getenv('RELEASE_PAGE_SIZE', 1000))           # linhas por página na reconciliação
+
+def mark_capsules_notified(capsule_ids, claimed_by=None):
+    """
+    Marca as cápsulas como notificadas com um UPDATE por bloco de IDs. Com
+    `claimed_by`, só altera as linhas ainda reservadas a este processo.
+    """
+    for i in range(0, len(capsule_ids), RELEASE_UPDATE_CHUNK):
+        if claimed_by is None:
+            query = supabase.table('capsules').update({'notificacao_enviada': True})
+        else:
+            query = supabase.table('capsules') \
+                .update({'notificacao_enviada': True, 'claimed_by': None, 'claimed_until': None}) \
+                .eq('claimed_by', claimed_by)
+        query.in_('id', capsule_ids[i:i + RELEASE_UPDATE_CHUNK]).execute()
+
+def notify_physical_capsules(capsules, claimed_by=None, lease_deadline=None):
     """
-    Função que o scheduler irá executar a cada minuto, usando a hora local (GMT-3).
+    Publica no MQTT um lote de cápsulas físicas vencidas e marca as confirmadas
+    como notificadas. Retorna os IDs notificados com sucesso; as que falharem
+    continuam pendentes no banco e voltam na próxima reconciliação.
+    Com `lease_deadline` (time.monotonic() do fim da reserva), não começa uma
+    janela que possa terminar depois dele: o restante volta quando a reserva vencer.
     """
     with app.app_context():
-        print(f"[{datetime.now()}] Executando job: Verificando cápsulas físicas expiradas...")
+        logger.info("Liberando cápsulas físicas", extra={"count": len(capsules)})
+        start = time.perf_counter()
+        delivered = []
+
+        now = datetime.now()
+        RELEASE_BATCH_SIZE.observe(len(capsules))
+        for capsule in capsules:
+            RELEASE_LAG.observe(max(0.0, (now - parse_release_date(capsule['release_date'])).total_seconds()))
+
+        # Janelas limitadas de publicações em pipeline pela mesma sessão MQTT
+        for i in range(0, len(capsules), RELEASE_PUBLISH_WINDOW):
+            if lease_deadline is not None and \
+                    time.monotonic() + MQTT_ACK_TIMEOUT + RELEASE_CLAIM_MARGIN_SECONDS > lease_deadline:
+                logger.warning("Reserva perto de expirar; cápsulas restantes ficam para outra reivindicação",
+                               extra={"count": len(capsules) - i})
+                break
+            window = capsules[i:i + RELEASE_PUBLISH_WINDOW]
+            futures = [(capsule, publish_mqtt(build_capsule_payload(capsule)))
+                       for capsule in window]
+            wait([future for _, future in futures], timeout=MQTT_ACK_TIMEOUT)
+
+            confirmed = []
+            for capsule, future in futures:
+                # Cancela o que ficou na fila: a próxima reconciliação enfileira de novo
+                future.cancel()
+                if future.cancelled() or future.exception() is not None:
+                    logger.warning("Falha ao publicar MQTT; nova tentativa na próxima reconciliação",
+                                   extra={"capsule_id": capsule['id']})
+                    continue
+                confirmed.append(capsule['id'])
+
+            try:
+                mark_capsules_notified(confirmed, claimed_by=claimed_by)
+                delivered.extend(confirmed)
+                confirmed_set = set(confirmed)
+                for user_id in {c.get('user_id') for c in window if c['id'] in confirmed_set}:
+                    if user_id:
+                        capsule_cache.invalidate_user(user_id)
+                for capsule in window:
+                    if capsule['id'] in confirmed_set and capsule.get('user_id'):
+                        event_broker.publish(capsule['user_id'], 'notified',
+                                             {**capsule_event_data(capsule), "tipo": "fisica"})
+            except Exception:
+                logger.exception("Erro ao marcar cápsulas como notificadas", extra={"count": len(confirmed)})
+
+        elapsed = time.perf_counter() - start
+        SCHEDULER_JOB_DURATION.observe(elapsed, 'release_batch')
+        logger.info("Lote de liberação concluído", extra={
+            "delivered": len(delivered), "count": len(capsules),
+            "seconds": round(elapsed, 3), "per_second": round(len(capsules) / elapsed, 1)
+        })
+        return delivered
+
+def fetch_pending_physical_capsules(horizon):
+    """
+    Percorre, em páginas com cursor por ID, as cápsulas físicas ainda não
+    notificadas com liberação até `horizon`.
+    """
+    cursor = None
+    while True:
+        query = supabase.table('capsules') \
+            .select('id, release_date, message, user_id') \
+            .eq('tipo', 'fisica') \
+            .eq('notificacao_enviada', False) \
+            .lte('release_date', horizon.isoformat())
+        if cursor is not None:
+            query = query.gt('id', cursor)
+        page = query.order('id').limit(RELEASE_PAGE_SIZE).execute().data or []
+        if page:
+            yield page
+        if len(page) < RELEASE_PAGE_SIZE:
+            return
+        cursor = page[-1]['id']
+
+# Índice de liberação: acorda exatamente na próxima release_date em vez de varrer o banco
+RELEASE_LOOKAHEAD_SECONDS = int(os.getenv('RELEASE_LOOKAHEAD_SECONDS', 900))
+RELEASE_RECONCILE_SECONDS = int(os.getenv('RELEASE_RECONCILE_SECONDS', 300))
+
+# Modo claim: tamanho de cada reivindicação, validade da reserva (deve superar
+# o tempo de publicar e marcar um bloco) e intervalo da varredura de segurança
+RELEASE_CLAIM_BATCH = int(os.getenv('RELEASE_CLAIM_BATCH', 500))
+RELEASE_CLAIM_LEASE_SECONDS = int(os.getenv('RELEASE_CLAIM_LEASE_SECONDS', 120))
+RELEASE_CLAIM_POLL_SECONDS = int(os.getenv('RELEASE_CLAIM_POLL_SECONDS', 30))
+RELEASE_CLAIM_MARGIN_SECONDS = float(os.getenv('RELEASE_CLAIM_MARGIN_SECONDS', 30))  # folga para marcar as notificadas
+
+# Pior caso de um bloco: janelas em sequência, cada uma esperando até MQTT_ACK_TIMEOUT
+# pelos PUBACKs. O bloco é limitado ao que cabe na reserva, para que ela não expire
+# no meio da publicação (outro processo reivindicaria e publicaria de novo).
+RELEASE_CLAIM_WINDOWS = int((RELEASE_CLAIM_LEASE_SECONDS - RELEASE_CLAIM_MARGIN_SECONDS) // MQTT_ACK_TIMEOUT)
+if SCHEDULER_MODE == 'claim':
+    if RELEASE_CLAIM_WINDOWS < 1:
+        raise ValueError("RELEASE_CLAIM_LEASE_SECONDS deve ser ao menos "
+                         "MQTT_ACK_TIMEOUT + RELEASE_CLAIM_MARGIN_SECONDS")
+    if RELEASE_CLAIM_BATCH > RELEASE_CLAIM_WINDOWS * RELEASE_PUBLISH_WINDOW:
+        logger.warning("RELEASE_CLAIM_BATCH reduzido para caber na reserva",
+                       extra={"configured": RELEASE_CLAIM_BATCH,
+                              "effective": RELEASE_CLAIM_WINDOWS * RELEASE_PUBLISH_WINDOW})
+        RELEASE_CLAIM_BATCH = RELEASE_CLAIM_WINDOWS * RELEASE_PUBLISH_WINDOW
+
+def scheduler_worker_id():
+    # Calculado na hora: com gunicorn --preload o PID muda depois do fork
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def release_claimed_capsules(batch=()):
+    """
+    Modo claim: reivindica em blocos as cápsulas vencidas ainda não notificadas
+    e as libera, até não sobrar nenhuma livre. Processos que acordam juntos
+    dividem o trabalho; cada cápsula é publicada por quem a reservou.
+    Retorna os IDs do lote do índice local, que não precisam mais ser disparados
+    por este processo (as que falharem voltam quando a reserva expirar).
+    """
+    worker = scheduler_worker_id()
+    with SCHEDULER_JOB_DURATION.time('claim_releases'):
+        while True:
+            # Medido antes da chamada: a reserva no banco começa um pouco depois
+            lease_deadline = time.monotonic() + RELEASE_CLAIM_LEASE_SECONDS
+            claimed = supabase.rpc('claim_due_capsules', {
+                "p_worker": worker,
+                "p_now": datetime.now().isoformat(),
+                "p_limit": RELEASE_CLAIM_BATCH,
+                "p_lease_seconds": RELEASE_CLAIM_LEASE_SECONDS
+            }).execute().data or []
+            if claimed:
+                notify_physical_capsules(claimed, claimed_by=worker, lease_deadline=lease_deadline)
+            if len(claimed) < RELEASE_CLAIM_BATCH:
+                break
+    return [capsule['id'] for capsule in batch]
+
+release_scheduler = ReleaseScheduler(
+    release_claimed_capsules if SCHEDULER_MODE == 'claim' else notify_physical_capsules,
+    lookahead=timedelta(seconds=RELEASE_LOOKAHEAD_SECONDS)
+)
+
+def reconcile_release_index():
+    """
+    Reconciliação periódica do índice de liberação, usando a hora local (GMT-3).
+    Carrega as cápsulas físicas pendentes até o fim da janela de antecedência;
+    as já vencidas (atrasadas ou que falharam antes) são liberadas na hora.
+    """
+    with app.app_context(), SCHEDULER_JOB_DURATION.time('reconcile_releases'):
+        logger.info("Executando job: reconciliando índice de liberação")
+        try:
+            horizon = datetime.now() + timedelta(seconds=RELEASE_LOOKAHEAD_SECONDS)
+
+            added = release_scheduler.load([], horizon)
+            for page in fetch_pending_physical_capsules(horizon):
+                added += release_scheduler.add_many(page)
+            logger.info("Índice de liberação reconciliado", extra={"added": added, **release_scheduler.stats()})
+
+        except Exception:
+            logger.exception("Erro no job agendado 'reconcile_release_index'")
+
+def release_backlog():
+    stats = release_scheduler.stats()
+    return {("scheduled",): stats["agendadas"], ("firing",): stats["em_processamento"]}
+
+Gauge("release_backlog", "Cápsulas físicas no índice de liberação, por estado", ("state",), fn=release_backlog)
+Gauge("mqtt_outbox_pending", "Publicações MQTT enfileiradas ou aguardando PUBACK",
+      fn=lambda: mqtt_publisher.stats()["pendentes"])
+Gauge("mqtt_connected", "1 se a sessão MQTT está conectada", fn=lambda: int(mqtt_publisher.is_connected()))
+Gauge("capsule_cache_stats", "Contadores e taxa de acerto do cache de leitura", ("stat",),
+      fn=lambda: {(k,): v for k, v in capsule_cache.stats().items() if k != 'backend'})
+Gauge("event_broker_stats", "Conexões SSE, usuários conectados e eventos publicados/entregues neste processo",
+      ("stat",), fn=lambda: {(k,): v for k, v in event_broker.stats().items()})
+
+def sweep_claims():
+    """ Modo claim: pega reservas expiradas e cápsulas criadas em outros processos. """
+    with app.app_context():
         try:
-            now_local_iso = datetime.now().isoformat()
-            
-            response = supabase.table('capsules') \
-                .select('id, release_date, message') \
-                .eq('tipo', 'fisica') \
-                .eq('notificacao_enviada', False) \
-                .lte('release_date', now_local_iso) \
-                .execute()
-
-            if not response.data:
-                print("Nenhuma cápsula física nova para notificar.")
-                return
-
-            print(f"Encontradas {len(response.data)} cápsulas físicas para processar.")
-
-            for capsule in response.data:
-                print(f"Processando cápsula ID: {capsule['id']}...")
-                
-                payload = {
-                    "capsula": {
-                        "id": str(capsule['id']),
-                        "tipo": "fisica",
-                        "tempo": { "abrir_em": capsule['release_date'] },
-                        "conteudo": { "mensagem": capsule.get('message', 'Cápsula física pronta!') }
-                    }
-                }
-                
-                if publish_to_mqtt(payload):
-                    supabase.table('capsules') \
-                        .update({'notificacao_enviada': True}) \
-                        .eq('id', capsule['id']) \
-                        .execute()
-                    print(f"Cápsula {capsule['id']} marcada como notificada.")
-                else:
-                    print(f"Falha ao publicar MQTT para a cápsula {capsule['id']}. Tentará novamente no próximo minuto.")
-
-        except Exception as e:
-            print("!!!!!! ERRO NO JOB AGENDADO 'check_expired_capsules' !!!!!!")
-            traceback.print_exc()
-
-@scheduler.task('interval', id='job_check_capsules', seconds=60, misfire_grace_time=900)
-def scheduled_job():
-    check_expired_capsules()
+            release_claimed_capsules()
+        except Exception:
+            logger.exception("Erro no job agendado 'sweep_claims'")
+
+def start_background_services():
+    """
+    Inicia a sessão MQTT, o índice de liberação e os jobs periódicos.
+    Chamada na importação, exceto com SCHEDULER_MODE=off.
+    """
+    mqtt_publisher.start()
+    atexit.register(mqtt_publisher.stop)
+    release_scheduler.start()
+    scheduler.add_job(id='job_reconcile_releases', func=reconcile_release_index, trigger='interval',
+                      seconds=RELEASE_RECONCILE_SECONDS, misfire_grace_time=900, next_run_time=datetime.now())
+    if SCHEDULER_MODE == 'claim':
+        scheduler.add_job(id='job_sweep_claims', func=sweep_claims, trigger='interval',
+                          seconds=RELEASE_CLAIM_POLL_SECONDS, misfire_grace_time=RELEASE_CLAIM_POLL_SECONDS)
+    scheduler.start()
+    logger.info("Agendador de liberações iniciado", extra={"mode": SCHEDULER_MODE})
+
+if SCHEDULER_MODE != 'off':
+    start_background_services()
 
 # --- FIM CÓDIGO MQTT E AGENDADOR ---
 
 
+# --- EVENTOS EM TEMPO REAL (SSE) ---
+
+# Índice de desbloqueio: mesmo heap de timers da liberação, mas com as cápsulas
+# (digitais e físicas) dos usuários conectados a este processo. Na release_date,
+# emite `unlocked` só para as conexões locais; não depende do banco nem do relay.
+UNLOCK_USERS_CHUNK = 100    # user_ids por consulta (o filtro in_() vai na URL)
+UNLOCK_BATCH_DELAY = 0.05   # espera para juntar conexões que chegam juntas (ex.: reconexão em massa)
+UNLOCK_FIELDS = 'id, release_date, tipo, user_id'
+_unlock_tracking_lock = threading.Lock()
+_unlock_pending = {}  # user_id -> desde quando procurar desbloqueios (None = agora)
+_unlock_pending_cond = threading.Condition()
+_unlock_loader = None
+
+def publish_unlocked_events(capsules):
+    for capsule in capsules:
+        event_broker.publish(capsule['user_id'], 'unlocked', capsule_event_data(capsule), local=True)
+    return [capsule['id'] for capsule in capsules]
+
+unlock_scheduler = ReleaseScheduler(publish_unlocked_events, lookahead=timedelta(seconds=RELEASE_LOOKAHEAD_SECONDS))
+
+def unlock_candidates_query(user_ids, since, horizon, cursor=None):
+    """ Cápsulas dos usuários liberadas em (since, horizon], por ID. """
+    query = supabase.table('capsules') \
+        .select(UNLOCK_FIELDS) \
+        .in_('user_id', user_ids) \
+        .gt('release_date', since.isoformat()) \
+        .lte('release_date', horizon.isoformat())
+    if cursor is not None:
+        query = query.gt('id', cursor)
+    return query.order('id').limit(RELEASE_PAGE_SIZE)
+
+def start_unlock_tracking():
+    """ Liga o índice de desbloqueio, o carregador e a reconciliação na primeira conexão SSE do processo. """
+    global _unlock_loader
+    with _unlock_tracking_lock:
+        unlock_scheduler.start()
+        if _unlock_loader is None:
+            _unlock_loader = threading.Thread(target=run_unlock_loader, name="unlock-loader", daemon=True)
+            _unlock_loader.start()
+        if scheduler.get_job('job_reconcile_unlocks') is None:
+            scheduler.add_job(id='job_reconcile_unlocks', func=reconcile_unlock_index, trigger='interval',
+                              seconds=RELEASE_RECONCILE_SECONDS, misfire_grace_time=900)
+        if not scheduler.running:
+            scheduler.start()
+
+def unlock_horizon():
+    """ Estende a janela do índice de desbloqueio e retorna o novo limite. """
+    horizon = datetime.now() + timedelta(seconds=RELEASE_LOOKAHEAD_SECONDS)
+    unlock_scheduler.load([], horizon)
+    return horizon
+
+def track_unlocks(since_by_user):
+    """
+    Indexa as cápsulas de cada usuário liberadas depois de `since_by_user[id]`
+    (None = agora) e até o fim da janela, com uma consulta por bloco de usuários.
+    """
+    now = datetime.now()
+    horizon = unlock_horizon()
+    user_ids = list(since_by_user)
+    for i in range(0, len(user_ids), UNLOCK_USERS_CHUNK):
+        chunk, cursor = user_ids[i:i + UNLOCK_USERS_CHUNK], None
+        since = min(since_by_user[user_id] or now for user_id in chunk)
+        while True:
+            page = unlock_candidates_query(chunk, since, horizon, cursor).execute().data or []
+            # A consulta usa o `since` mais antigo do bloco; cada usuário só recebe o que perdeu
+            unlock_scheduler.add_many([c for c in page if parse_release_date(c['release_date'])
+                                       > (since_by_user[c['user_id']] or now)])
+            if len(page) < RELEASE_PAGE_SIZE:
+                break
+            cursor = page[-1]['id']
+
+def request_unlock_tracking(user_id, since=None):
+    """ Enfileira um usuário recém-conectado para o carregador em lote; não bloqueia. """
+    start_unlock_tracking()
+    with _unlock_pending_cond:
+        if user_id in _unlock_pending and since is not None:
+            previous = _unlock_pending[user_id]
+            since = since if previous is None else min(previous, since)
+        _unlock_pending[user_id] = since
+        _unlock_pending_cond.notify()
+
+def run_unlock_loader():
+    """ Thread do carregador: junta as conexões pendentes e indexa todas de uma vez. """
+    while True:
+        with _unlock_pending_cond:
+            while not _unlock_pending:
+                _unlock_pending_cond.wait()
+        time.sleep(UNLOCK_BATCH_DELAY)
+        with _unlock_pending_cond:
+            batch = dict(_unlock_pending)
+            _unlock_pending.clear()
+        try:
+            track_unlocks(batch)
+        except Exception:
+            logger.exception("Erro ao indexar desbloqueios", extra={"users": len(batch)})
+
+def reconcile_unlock_index():
+    """ Job periódico: avança a janela do índice de desbloqueio para os usuários conectados. """
+    with app.app_context(), SCHEDULER_JOB_DURATION.time('reconcile_unlocks'):
+        try:
+            track_unlocks(dict.fromkeys(event_broker.subscribed_users()))
+        except Exception:
+            logger.exception("Erro no job agendado 'reconcile_unlock_index'")
+
+def unlock_resume_since(subscription, last_event_id):
+    """
+    Desde quando procurar desbloqueios para uma conexão: o instante do último
+    evento recebido, se ela está retomando, ou agora. Lacunas maiores que a
+    janela de antecedência viram `reset` (o cliente recarrega a lista).
+    """
+    now = datetime.now()
+    since = event_time(last_event_id) if last_event_id and not subscription.lagged else None
+    if since is None:
+        return now
+    if since < now - timedelta(seconds=RELEASE_LOOKAHEAD_SECONDS):
+        subscription.reset()
+        return now
+    return min(since, now)
+
+def event_stream_key():
+    """
+    Chave dos tokens de stream, derivada de JWT_SECRET_KEY. Com uma chave própria
+    a assinatura não confere entre os dois tipos: as demais rotas recusam o token
+    de stream e o stream recusa o token de acesso.
+    """
+    secret = app.config['JWT_SECRET_KEY'].encode()
+    return hmac.new(secret, EVENTS_TOKEN_AUDIENCE.encode(), hashlib.sha256).hexdigest()
+
+def event_stream_token_payload(user_id):
+    """
+    Resposta de POST /capsules/events/token: um JWT que vale só para abrir o
+    stream e expira em EVENTS_TOKEN_TTL segundos.
+    """
+    now = datetime.now(timezone.utc)
+    claims = {app.config['JWT_IDENTITY_CLAIM']: user_id, "aud": EVENTS_TOKEN_AUDIENCE,
+              "iat": now, "exp": now + timedelta(seconds=EVENTS_TOKEN_TTL)}
+    token = encode_jwt(claims, event_stream_key(), algorithm='HS256')
+    return {"token": token, "expires_in": EVENTS_TOKEN_TTL}
+
+def event_stream_identity(args, headers):
+    """
+    Usuário de uma conexão SSE, a partir do token de stream (`?token=`, já que o
+    EventSource do navegador não envia cabeçalhos, ou Authorization). O token
+    só precisa valer na conexão. Retorna (user_id, erro).
+    """
+    header = headers.get('Authorization', '')
+    token = header[len('Bearer '):] if header.startswith('Bearer ') else args.get('token')
+    if not token:
+        return None, ("Missing token", 401)
+    try:
+        claims = decode_jwt(token, event_stream_key(), algorithms=['HS256'], audience=EVENTS_TOKEN_AUDIENCE)
+    except ExpiredSignatureError:
+        return None, ("Token has expired", 401)
+    except Exception as e:
+        return None, (str(e), 422)
+    return claims[app.config['JWT_IDENTITY_CLAIM']], None
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# --- FIM EVENTOS EM TEMPO REAL ---
+
+
 # --- ROTAS DA APLICAÇÃO ---
 
+# Índice espacial das cápsulas com localização, usado por /capsules/nearby
+NEARBY_DEFAULT_RADIUS = float(os.getenv('NEARBY_DEFAULT_RADIUS', 100))   # metros
+NEARBY_MAX_RADIUS = float(os.getenv('NEARBY_MAX_RADIUS', 50000))         # metros
+NEARBY_PAGE_SIZE = 1000
+NEARBY_FIELDS = ('id', 'message', 'release_date', 'lat', 'lng', 'tipo')
+spatial_index = SpatialIndex(ttl=int(os.getenv('NEARBY_INDEX_TTL', 300)),
+                             max_users=int(os.getenv('NEARBY_INDEX_MAX_USERS', 1000)))
+
 @app.route('/test-mqtt')
 def test_mqtt():
     """ Rota de teste para forçar uma publicação MQTT. """
-    print("Forçando publicação MQTT de teste...")
+    logger.info("Forçando publicação MQTT de teste")
+    mqtt_publisher.start()  # Com SCHEDULER_MODE=off a sessão só abre quando necessária
     payload_teste = {
         "capsula": {
             "id": "teste-12345",
@@ -168,116 +645,579 @@ def test_mqtt():
     else:
         return "Falha ao enviar mensagem MQTT de teste. Verifique os logs.", 500
 
+@app.route('/metrics')
+def metrics():
+    """ Métricas no formato de texto do Prometheus. """
+    body = metrics_collector.render() if metrics_collector is not None else REGISTRY.render()
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/cache/stats')
+def cache_stats():
+    """ Contadores do cache de leitura (acertos, falhas, taxa de acerto) para dimensionamento. """
+    return jsonify(capsule_cache.stats()), 200
+
+# Lógica compartilhada com asgi.py: as rotas dos dois modos só diferem no I/O
+def login_credentials(data):
+    """ Credenciais do corpo do /login. Lança ValueError se incompletas. """
+    if not data or 'email' not in data or 'password' not in data:
+        raise ValueError("Email e senha são obrigatórios")
+    return {"email": data['email'], "password": data['password']}
+
+def login_payload(user_id):
+    """ Resposta do /login (requer o contexto do app Flask para emitir o JWT). """
+    return { "access_token": create_access_token(identity=user_id), "user_id": user_id }
+
 @app.route('/login', methods=['POST'])
 def login():
     try:
-        data = request.get_json(force=True)
-        if not data or 'email' not in data or 'password' not in data:
-            return jsonify({"error": "Email e senha são obrigatórios"}), 400
-        auth_data = supabase.auth.sign_in_with_password({
-            "email": data['email'],
-            "password": data['password']
-        })
-        access_token = create_access_token(identity=auth_data.user.id)
-        return jsonify({ "access_token": access_token, "user_id": auth_data.user.id }), 200
+        try:
+            credentials = login_credentials(request.get_json(force=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        auth_data = supabase.auth.sign_in_with_password(credentials)
+        return jsonify(login_payload(auth_data.user.id)), 200
     except Exception as e:
-        print(f"Erro no login: {str(e)}")
-        traceback.print_exc() 
+        logger.exception("Erro no login")
         return jsonify({"error": str(e)}), 401
 
+CAPSULE_TYPES = ('digital', 'fisica')
+
+def optional_coordinate(data, field, limit):
+    """ Lê `lat`/`lng` opcional (número ou texto numérico); lança ValueError se inválido. """
+    value = data.get(field)
+    if value is None or value == '':
+        return None
+    try:
+        coordinate = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Campo '{field}' deve ser numérico")
+    if isinstance(value, bool) or not math.isfinite(coordinate) or abs(coordinate) > limit:
+        raise ValueError(f"Campo '{field}' deve estar entre -{limit} e {limit}")
+    return coordinate
+
+def build_capsule_rows(data, user_id):
+    """
+    Valida o corpo de criação de uma cápsula e monta as linhas de `capsules` e
+    `capsule_media` (estas ainda sem `capsule_id`). Lança ValueError se inválido.
+    """
+    if not data or not isinstance(data, dict):
+        raise ValueError("Dados inválidos")
+    if 'open_date' not in data:
+        raise ValueError("Campo 'open_date' é obrigatório")
+    message = data.get('message')
+    media_files = data.get('media_files') or []
+    if not message and not media_files:
+        raise ValueError("A cápsula deve conter ao menos uma mensagem ou um arquivo de mídia")
+    # Valores inválidos são recusados aqui, por cápsula: no banco, um deles
+    # derrubaria o bloco inteiro da criação em lote
+    try:
+        parse_release_date(data['open_date'])
+    except (TypeError, ValueError):
+        raise ValueError("Campo 'open_date' deve ser uma data ISO 8601")
+    tipo = data.get('tipo', 'digital')
+    if tipo not in CAPSULE_TYPES:
+        raise ValueError(f"Campo 'tipo' deve ser um de: {', '.join(CAPSULE_TYPES)}")
+
+    capsule_row = {
+        "message": message,
+        "release_date": data['open_date'], # Salva a hora local (naive)
+        "lat": optional_coordinate(data, 'lat', 90),
+        "lng": optional_coordinate(data, 'lng', 180),
+        "user_id": user_id,
+        "tipo": tipo
+    }
+    media_rows = [
+        {"storage_path": media['storage_path'], "media_type": media['media_type']}
+        for media in media_files
+        if isinstance(media, dict) and 'storage_path' in media and 'media_type' in media
+    ]
+    return capsule_row, media_rows
+
+def inserted_capsule_id(response_capsule):
+    if not response_capsule.data:
+        raise Exception("Falha ao inserir na tabela 'capsules'")
+    return response_capsule.data[0]['id']
+
+def media_insert_rows(media_rows, capsule_id):
+    return [{**media, "capsule_id": capsule_id} for media in media_rows]
+
+def check_media_inserted(response_media):
+    if not response_media.data:
+        raise Exception("Falha ao inserir mídias na tabela 'capsule_media'")
+
+def register_new_capsules(user_id, capsules):
+    """
+    Atualiza cache, índice de liberação e índice espacial após criar cápsulas.
+    As cápsulas já estão gravadas: uma falha aqui só vai para o log e nunca
+    deve levar o chamador a desfazer a criação.
+    """
+    try:
+        capsule_cache.invalidate_user(user_id)
+        # Cápsulas físicas entram direto no índice de liberação (se este processo libera)
+        if SCHEDULER_MODE != 'off':
+            release_scheduler.add_many([c for c in capsules if c.get('tipo') == 'fisica'])
+        # Usuário conectado por SSE neste processo: o desbloqueio também vira evento
+        if event_broker.has_subscribers(user_id):
+            unlock_scheduler.add_many(capsules)
+        for capsule in capsules:
+            spatial_index.add(user_id, {k: capsule.get(k) for k in NEARBY_FIELDS})
+    except Exception:
+        logger.exception("Erro ao registrar cápsulas criadas", extra={"count": len(capsules)})
+
 @app.route('/capsules', methods=['POST'])
 @jwt_required()
 def create_capsule():
     try:
         data = request.get_json(force=True, silent=True)
-        if not data:
-            return jsonify({"error": "Dados inválidos"}), 400
         current_user_id = get_jwt_identity()
-        if 'open_date' not in data:
-            return jsonify({"error": "Campo 'open_date' é obrigatório"}), 400
-        message = data.get('message')
-        media_files = data.get('media_files', [])
-        if not message and not media_files:
-            return jsonify({"error": "A cápsula deve conter ao menos uma mensagem ou um arquivo de mídia"}), 400
-
-        response_capsule = supabase.table('capsules').insert({
-            "message": message,
-            "release_date": data['open_date'], # Salva a hora local (naive)
-            "lat": data.get('lat'),
-            "lng": data.get('lng'),
-            "user_id": current_user_id,
-            "tipo": data.get('tipo', 'digital')
-        }).execute()
-
-        if not response_capsule.data:
-            raise Exception("Falha ao inserir na tabela 'capsules'")
-        capsule_id = response_capsule.data[0]['id']
-
-        if media_files:
-            media_to_insert = []
-            for media in media_files:
-                if 'storage_path' in media and 'media_type' in media:
-                    media_to_insert.append({
-                        "capsule_id": capsule_id,
-                        "storage_path": media['storage_path'],
-                        "media_type": media['media_type']
-                    })
-            if media_to_insert:
-                response_media = supabase.table('capsule_media').insert(media_to_insert).execute()
-                if not response_media.data:
-                    raise Exception("Falha ao inserir mídias na tabela 'capsule_media'")
-        return jsonify({ "status": "success", "capsule_id": capsule_id }), 201
+        try:
+            capsule_row, media_rows = build_capsule_rows(data, current_user_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        response_capsule = supabase.table('capsules').insert(capsule_row).execute()
+        capsule_id = inserted_capsule_id(response_capsule)
+
+        if media_rows:
+            response_media = supabase.table('capsule_media').insert(media_insert_rows(media_rows, capsule_id)).execute()
+            check_media_inserted(response_media)
     except Exception as e:
-        print(f"\nErro na criação da cápsula: {str(e)}")
-        traceback.print_exc() 
+        logger.exception("Erro na criação da cápsula")
         if 'capsule_id' in locals():
             supabase.table('capsules').delete().eq('id', capsule_id).execute()
+            capsule_cache.invalidate_user(current_user_id)
+        return jsonify({ "error": "Erro ao processar a requisição", "details": str(e) }), 500
+
+    # Fora do try: a cápsula já está gravada e não deve ser desfeita
+    register_new_capsules(current_user_id, response_capsule.data)
+    return jsonify({ "status": "success", "capsule_id": capsule_id }), 201
+
+# Criação em lote: blocos de várias linhas, de preferência via RPC (um bloco = uma transação)
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 500))
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', 50000))
+BULK_USE_RPC = os.getenv('BULK_USE_RPC', '1') == '1'
+bulk_rpc_available = BULK_USE_RPC
+
+def insert_capsule_chunk(chunk):
+    """
+    Grava um bloco de (capsule_row, media_rows). Com a função SQL
+    `bulk_create_capsules` (backend/sql) o bloco é atômico; sem ela, usa inserts
+    de várias linhas com exclusão compensatória em caso de falha.
+    Retorna as cápsulas criadas, na ordem do bloco.
+    """
+    global bulk_rpc_available
+    if bulk_rpc_available:
+        try:
+            payload = [{"capsule": capsule, "media": media} for capsule, media in chunk]
+            created = supabase.rpc('bulk_create_capsules', {"p_rows": payload}).execute().data or []
+            if len(created) != len(chunk):
+                # Sem uma linha por entrada não dá para associar os resultados aos índices
+                if created:
+                    supabase.table('capsules').delete().in_('id', [c['id'] for c in created]).execute()
+                raise Exception("Falha ao inserir o bloco via 'bulk_create_capsules'")
+            return created
+        except APIError as e:
+            if e.code != 'PGRST202':  # Função inexistente: cai para o modo sem RPC
+                raise
+            logger.warning("Função 'bulk_create_capsules' não encontrada; usando inserts em lote")
+            bulk_rpc_available = False
+
+    response_capsules = supabase.table('capsules').insert([capsule for capsule, _ in chunk]).execute()
+    created = response_capsules.data or []
+    if len(created) != len(chunk):
+        raise Exception("Falha ao inserir o bloco na tabela 'capsules'")
+    try:
+        media_to_insert = [{**media, "capsule_id": capsule['id']}
+                           for capsule, (_, media_rows) in zip(created, chunk)
+                           for media in media_rows]
+        if media_to_insert:
+            response_media = supabase.table('capsule_media').insert(media_to_insert).execute()
+            if not response_media.data:
+                raise Exception("Falha ao inserir mídias na tabela 'capsule_media'")
+    except Exception:
+        supabase.table('capsules').delete().in_('id', [c['id'] for c in created]).execute()
+        raise
+    return created
+
+def iter_bulk_rows():
+    """
+    Lê as linhas do corpo da requisição: NDJSON (uma cápsula por linha, lido
+    em streaming) ou um array JSON (ou {"capsules": [...]}). Produz (dados, erro).
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line), None
+            except ValueError:
+                yield None, "JSON inválido"
+        return
+
+    data = request.get_json(force=True, silent=True)
+    if isinstance(data, dict):
+        data = data.get('capsules')
+    if not isinstance(data, list):
+        raise ValueError("Envie um array de cápsulas ou NDJSON")
+    for item in data:
+        yield item, None
+
+@app.route('/capsules/bulk', methods=['POST'])
+@jwt_required()
+def bulk_create_capsules():
+    """
+    Cria várias cápsulas em uma requisição. Cada linha é validada assim que
+    chega e gravada em blocos de BULK_CHUNK_SIZE. A resposta traz o resultado
+    de cada linha, pelo índice na entrada.
+    """
+    try:
+        current_user_id = get_jwt_identity()
+        results = []
+        chunk, chunk_indexes = [], []
+
+        def flush_chunk():
+            created = []
+            try:
+                created = insert_capsule_chunk(chunk)
+            except Exception as e:
+                logger.exception("Erro ao gravar bloco de cápsulas", extra={"count": len(chunk)})
+                for index in chunk_indexes:
+                    results.append({"index": index, "status": "error", "error": str(e)})
+            for index, capsule in zip(chunk_indexes, created):
+                results.append({"index": index, "status": "created", "capsule_id": capsule['id']})
+            chunk.clear()
+            chunk_indexes.clear()
+            if created:
+                register_new_capsules(current_user_id, created)
+
+        try:
+            for index, (data, error) in enumerate(iter_bulk_rows()):
+                if index >= BULK_MAX_ROWS:
+                    results.append({"index": index, "status": "error",
+                                    "error": f"Limite de {BULK_MAX_ROWS} cápsulas por requisição; linhas seguintes ignoradas"})
+                    break
+                if error is None:
+                    try:
+                        chunk.append(build_capsule_rows(data, current_user_id))
+                        chunk_indexes.append(index)
+                    except ValueError as e:
+                        error = str(e)
+                if error is not None:
+                    results.append({"index": index, "status": "error", "error": error})
+                if len(chunk) >= BULK_CHUNK_SIZE:
+                    flush_chunk()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if chunk:
+            flush_chunk()
+
+        results.sort(key=lambda r: r['index'])
+        created = sum(1 for r in results if r['status'] == 'created')
+        return jsonify({"created": created, "failed": len(results) - created, "results": results}), 200
+    except Exception as e:
+        logger.exception("Erro na criação em lote")
         return jsonify({ "error": "Erro ao processar a requisição", "details": str(e) }), 500
 
+# Listagem paginada: cursor (keyset) sobre (created_at, id), do mais novo ao mais antigo
+LIST_FIELDS = ('id', 'message', 'image_url', 'release_date', 'lat', 'lng', 'created_at', 'tipo')
+LIST_MAX_LIMIT = int(os.getenv('LIST_MAX_LIMIT', 200))
+LIST_STATUSES = ('locked', 'available', 'physical')
+LIST_TIME_STATUSES = ('locked', 'available')  # O resultado depende da hora atual
+
+def encode_list_cursor(capsule):
+    raw = json.dumps([capsule['created_at'], capsule['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+LIST_CURSOR_ID = re.compile(r'^[0-9A-Za-z-]{1,64}$')
+
+def decode_list_cursor(cursor):
+    """
+    Decodifica o cursor em (created_at, id). Os valores vão para o filtro do
+    PostgREST, então são validados aqui: um cursor adulterado gera ValueError.
+    """
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    created_at, capsule_id = json.loads(raw)
+    if not isinstance(created_at, str):
+        raise ValueError("created_at inválido no cursor")
+    datetime.fromisoformat(created_at)
+    if isinstance(capsule_id, bool) or not isinstance(capsule_id, (str, int)) \
+            or not LIST_CURSOR_ID.match(str(capsule_id)):
+        raise ValueError("id inválido no cursor")
+    return created_at, capsule_id
+
+def parse_list_args(args):
+    """
+    Valida os parâmetros de listagem. Retorna (params, erro); `params` traz
+    limit, cursor, keyset, status e os campos selecionados.
+    """
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+    except ValueError:
+        limit = 0
+    cursor = args.get('cursor')
+    status = args.get('status')
+    fields = args.get('fields')
+
+    if limit is not None and not 1 <= limit <= LIST_MAX_LIMIT:
+        return None, f"'limit' deve estar entre 1 e {LIST_MAX_LIMIT}"
+    if status is not None and status not in LIST_STATUSES:
+        return None, f"'status' deve ser um de: {', '.join(LIST_STATUSES)}"
+    if fields:
+        selected = [f.strip() for f in fields.split(',') if f.strip()]
+        invalid = [f for f in selected if f not in LIST_FIELDS]
+        if invalid:
+            return None, f"Campos inválidos: {', '.join(invalid)}"
+        # id e created_at são sempre necessários para o cursor
+        selected = [f for f in LIST_FIELDS if f in selected or f in ('id', 'created_at')]
+    else:
+        selected = list(LIST_FIELDS)
+
+    keyset = None
+    if cursor:
+        try:
+            keyset = decode_list_cursor(cursor)
+        except Exception:
+            return None, "Cursor inválido"
+
+    return {"limit": limit, "cursor": cursor, "keyset": keyset,
+            "status": status, "select": ','.join(selected)}, None
+
+def apply_list_query(query, params):
+    """ Aplica filtros, cursor, ordenação e limite a uma consulta (síncrona ou assíncrona). """
+    now_local_iso = datetime.now().isoformat()
+    if params['status'] == 'locked':
+        query = query.gt('release_date', now_local_iso)
+    elif params['status'] == 'available':
+        query = query.lte('release_date', now_local_iso)
+    elif params['status'] == 'physical':
+        query = query.eq('tipo', 'fisica')
+
+    if params['keyset']:
+        created_at, last_id = params['keyset']
+        query = query.or_(f'created_at.lt."{created_at}",'
+                          f'and(created_at.eq."{created_at}",id.lt."{last_id}")')
+
+    query = query.order('created_at', desc=True).order('id', desc=True)
+    if params['limit'] is not None:
+        query = query.limit(params['limit'] + 1)  # Uma linha extra indica se há próxima página
+    return query
+
+def list_summary_query(table, user_id):
+    """
+    Resumo das cápsulas do usuário: a quantidade (count=exact) e a mais nova.
+    Os campos listados não mudam depois da criação, então o resumo só muda
+    quando uma cápsula é criada ou removida.
+    """
+    return table.select('id,created_at', count='exact').eq('user_id', user_id) \
+                .order('created_at', desc=True).order('id', desc=True).limit(1)
+
+def list_page_etag(summary, params):
+    """ ETag de uma página a partir do resumo, sem ler nem serializar a página. """
+    newest = summary.data[0] if summary.data else {}
+    state = [summary.count, newest.get('created_at'), newest.get('id'),
+             params['limit'], params['cursor'], params['select'], params['status']]
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+def render_list_page(rows, limit, etag=None):
+    """
+    Serializa uma página da listagem. Retorna [corpo JSON, ETag]; sem `etag`
+    (filtros que dependem da hora), o ETag é o hash do corpo.
+    """
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_list_cursor(rows[-1])
+
+    body = json.dumps({"capsules": rows, "next_cursor": next_cursor}, separators=(',', ':'))
+    return [body, etag or hashlib.sha256(body.encode()).hexdigest()]
+
+def list_cache_parts(params):
+    """
+    Partes da chave de cache da página, ou None se o filtro depende da hora
+    atual ou se a listagem não é paginada (até milhares de linhas por entrada).
+    """
+    if params['limit'] is None or params['status'] in LIST_TIME_STATUSES:
+        return None
+    return ('list', params['limit'], params['cursor'], params['select'], params['status'])
+
+def list_cache_key(user_id, params):
+    parts = list_cache_parts(params)
+    return None if parts is None else capsule_cache.user_key(user_id, *parts)
+
+def prepare_list_response(response, etag):
+    """ ETag forte e revalidação obrigatória; o chamador aplica make_conditional. """
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/capsules', methods=['GET'])
 @jwt_required()
 def list_capsules():
+    """
+    Parâmetros opcionais:
+      limit  - tamanho da página (sem ele, retorna todas as cápsulas)
+      cursor - valor de `next_cursor` da página anterior
+      fields - projeção, ex.: fields=id,message,release_date
+      status - locked | available | physical
+    Responde com ETag forte; um If-None-Match igual recebe 304. Fora dos
+    filtros por hora, o ETag vem de um resumo das cápsulas (uma linha e a
+    contagem), então o 304 sai sem ler nem serializar a página.
+    """
     try:
         user_id = get_jwt_identity()
-        select_query = 'id,message,image_url,release_date,lat,lng,created_at,tipo'
-        response = supabase.table('capsules').select(select_query).eq('user_id', user_id).execute()
-        return jsonify({"capsules": response.data}), 200
+        params, error = parse_list_args(request.args)
+        if error:
+            return jsonify({"error": error}), 400
+
+        def load_page(etag=None):
+            query = supabase.table('capsules').select(params['select']).eq('user_id', user_id)
+            rows = apply_list_query(query, params).execute().data or []
+            return render_list_page(rows, params['limit'], etag)
+
+        def summary_etag():
+            return list_page_etag(list_summary_query(supabase.table('capsules'), user_id).execute(), params)
+
+        key = list_cache_key(user_id, params)
+        if key is not None:
+            body, etag = capsule_cache.get_or_load(key, lambda: load_page(summary_etag()))
+        elif params['status'] in LIST_TIME_STATUSES:
+            body, etag = load_page()
+        else:
+            # Sem cache: o resumo decide o 304 antes de ler e serializar a página
+            etag = summary_etag()
+            if request.if_none_match.contains(etag):
+                return prepare_list_response(app.response_class(status=304), etag)
+            body, etag = load_page(etag)
+
+        response = prepare_list_response(app.response_class(body, status=200, mimetype='application/json'), etag)
+        return response.make_conditional(request)
     except Exception as e:
-        print(f"Erro ao listar cápsulas: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Erro ao listar cápsulas")
         return jsonify({"error": str(e)}), 500
 
+# Resolução de URLs de mídia: um lote por cápsula, memoizado em cache com TTL
+MEDIA_BUCKET = 'capsule-media'
+MEDIA_BUCKET_PRIVATE = os.getenv('MEDIA_BUCKET_PRIVATE', '0') == '1'
+MEDIA_SIGNED_URL_TTL = int(os.getenv('MEDIA_SIGNED_URL_TTL', 3600))
+CAPSULE_OPEN_RADIUS_KM = 0.1  # 100 metros
+CAPSULE_WITH_MEDIA_SELECT = '*, capsule_media(media_type, storage_path)'
+CAPSULE_LOCKED_FIELDS = ('id', 'release_date', 'lat', 'lng', 'tipo')
+media_url_cache = TTLCache(maxsize=50000, ttl=MEDIA_SIGNED_URL_TTL * 0.8)
+
+def resolve_media_urls(storage_paths):
+    """
+    Retorna {storage_path: url}. Com bucket privado, gera URLs assinadas em uma
+    única chamada ao Storage; elas ficam em cache por 80% da validade para nunca
+    serem servidas já expiradas.
+    """
+    urls, missing = cached_media_urls(storage_paths)
+    if not missing:
+        return urls
+    bucket = supabase.storage.from_(MEDIA_BUCKET)
+    if MEDIA_BUCKET_PRIVATE:
+        remember_media_urls(urls, signed_media_urls(bucket.create_signed_urls(missing, MEDIA_SIGNED_URL_TTL)))
+    else:
+        remember_media_urls(urls, [(path, bucket.get_public_url(path)) for path in missing])
+    return urls
+
+def cached_media_urls(storage_paths):
+    """ Retorna ({storage_path: url} já em cache, caminhos que faltam resolver). """
+    urls = media_url_cache.get_many(storage_paths)
+    return urls, [path for path in dict.fromkeys(storage_paths) if path not in urls]
+
+def signed_media_urls(signed_urls):
+    """ Pares (storage_path, url) válidos da resposta de create_signed_urls. """
+    for signed in signed_urls:
+        url = signed.get('signedURL') or signed.get('signedUrl')
+        if url and not signed.get('error'):
+            yield signed['path'], url
+
+def remember_media_urls(urls, resolved):
+    for path, url in resolved:
+        urls[path] = url
+        media_url_cache.set(path, url)
+
+def fetch_capsule(user_id, capsule_id):
+    """
+    Busca a cápsula com suas mídias embutidas, em uma única consulta,
+    passando pelo cache de leitura. O dict retornado não deve ser alterado.
+    """
+    def load():
+        response = supabase.table('capsules') \
+                         .select(CAPSULE_WITH_MEDIA_SELECT) \
+                         .eq('id', capsule_id) \
+                         .eq('user_id', user_id) \
+                         .execute()
+        return response.data[0] if response.data else None
+
+    return capsule_cache.get_or_load(capsule_cache.user_key(user_id, 'capsule', capsule_id), load)
+
+def media_paths(capsule):
+    return [media['storage_path'] for media in capsule.get('capsule_media') or []]
+
+def attach_media_urls(capsule, urls):
+    """ Troca as linhas de `capsule_media` pela lista `media_files` com URLs. """
+    capsule_data = dict(capsule)
+    media_rows = capsule_data.pop('capsule_media', None) or []
+    capsule_data['media_files'] = [
+        {"type": media['media_type'], "url": urls[media['storage_path']]}
+        for media in media_rows if media['storage_path'] in urls
+    ]
+    return capsule_data
+
+def with_media_urls(capsule):
+    return attach_media_urls(capsule, resolve_media_urls(media_paths(capsule)))
+
+def evaluate_capsule_access(capsule, user_lat, user_lng):
+    """ Aplica as regras de tempo e de localização. Retorna (pode_abrir, motivo). """
+    now_local = datetime.now()
+    release_date_local = parse_release_date(capsule['release_date'])
+
+    if now_local < release_date_local:
+        return False, f"Disponível em {release_date_local.strftime('%d/%m/%Y %H:%M')}"
+
+    if capsule['lat'] and capsule['lng']:
+        if user_lat is None or user_lng is None:
+            return False, "Esta cápsula requer sua localização. Por favor, habilite-a."
+
+        distance = calculate_distance( capsule['lat'], capsule['lng'], user_lat, user_lng )
+
+        if distance > CAPSULE_OPEN_RADIUS_KM:
+            return False, "Você não está no local correto"
+
+    return True, None
+
+CAPSULE_NOT_FOUND = "Cápsula não encontrada"
+CAPSULE_NOT_OWNED = "Cápsula não encontrada ou pertence a outro usuário"
+
+def request_coordinates(args):
+    """ lat/lng opcionais da query string (None se ausentes ou inválidos). """
+    return args.get('lat', type=float), args.get('lng', type=float)
+
+def check_payload(capsule, user_lat, user_lng):
+    """ Resposta do /check. """
+    can_open, reason = evaluate_capsule_access(capsule, user_lat, user_lng)
+    return {"can_open": True} if can_open else {"can_open": False, "reason": reason}
+
+def locked_open_payload(capsule, user_lat, user_lng):
+    """ Resposta do /open se a cápsula estiver trancada; None se puder ser aberta. """
+    can_open, reason = evaluate_capsule_access(capsule, user_lat, user_lng)
+    if can_open:
+        return None
+    return {"can_open": False, "reason": reason, "capsule": {k: capsule.get(k) for k in CAPSULE_LOCKED_FIELDS}}
+
 @app.route('/capsules/<capsule_id>', methods=['GET'])
 @jwt_required()
 def get_capsule(capsule_id):
     try:
         user_id = get_jwt_identity()
-        response = supabase.table('capsules') \
-                         .select('*') \
-                         .eq('id', capsule_id) \
-                         .eq('user_id', user_id) \
-                         .execute()
-        if not response.data:
-            return jsonify({"error": "Cápsula não encontrada ou pertence a outro usuário"}), 404
-        capsule_data = response.data[0]
-        response_media = supabase.table('capsule_media') \
-                               .select('media_type, storage_path') \
-                               .eq('capsule_id', capsule_id) \
-                               .execute()
-        media_files_with_urls = []
-        if response_media.data:
-            for media in response_media.data:
-                public_url = supabase.storage.from_('capsule-media') \
-                                           .get_public_url(media['storage_path'])
-                media_files_with_urls.append({
-                    "type": media['media_type'],
-                    "url": public_url
-                })
-        capsule_data['media_files'] = media_files_with_urls
-        return jsonify(capsule_data), 200
+        capsule = fetch_capsule(user_id, capsule_id)
+        if capsule is None:
+            return jsonify({"error": CAPSULE_NOT_OWNED}), 404
+        return jsonify(with_media_urls(capsule)), 200
     except Exception as e:
-        print(f"Erro ao buscar cápsula: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Erro ao buscar cápsula")
         return jsonify({"error": "Erro interno do servidor", "details": str(e)}), 500
 
 @app.route('/capsules/<capsule_id>/check', methods=['GET'])
@@ -285,39 +1225,148 @@ def get_capsule(capsule_id):
 def check_capsule(capsule_id):
     try:
         user_id = get_jwt_identity()
-        user_lat = request.args.get('lat', type=float)
-        user_lng = request.args.get('lng', type=float)
-
-        response = supabase.table('capsules').select('release_date,lat,lng').eq('id', capsule_id).eq('user_id', user_id).execute()
-        if not response.data:
-            return jsonify({"error": "Cápsula não encontrada"}), 404
-        capsule = response.data[0]
-
-        now_local = datetime.now() 
-        release_date_local = datetime.fromisoformat(capsule['release_date'])
-        
-        if now_local < release_date_local:
-            return jsonify({
-                "can_open": False,
-                "reason": f"Disponível em {release_date_local.strftime('%d/%m/%Y %H:%M')}"
-            }), 200
-
-        if capsule['lat'] and capsule['lng']:
-            if user_lat is None or user_lng is None:
-                return jsonify({ "can_open": False, "reason": "Esta cápsula requer sua localização. Por favor, habilite-a." }), 200
-            
-            distance = calculate_distance( capsule['lat'], capsule['lng'], user_lat, user_lng )
-            
-            if distance > 0.1:  # 100 metros
-                return jsonify({ "can_open": False, "reason": "Você não está no local correto" }), 200
-
-        return jsonify({"can_open": True}), 200
+        user_lat, user_lng = request_coordinates(request.args)
+
+        capsule = fetch_capsule(user_id, capsule_id)
+        if capsule is None:
+            return jsonify({"error": CAPSULE_NOT_FOUND}), 404
+        return jsonify(check_payload(capsule, user_lat, user_lng)), 200
 
     except Exception as e:
-        print(f"Erro ao checar cápsula: {str(e)}")
-        traceback.print_exc() 
+        logger.exception("Erro ao checar cápsula")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/capsules/<capsule_id>/open', methods=['GET'])
+@jwt_required()
+def open_capsule(capsule_id):
+    """
+    Verificação de tempo/localização e dados da cápsula em uma única ida ao
+    backend. Trancada, só devolve o necessário para a tela de bloqueio.
+    """
+    try:
+        user_id = get_jwt_identity()
+        user_lat, user_lng = request_coordinates(request.args)
+
+        capsule = fetch_capsule(user_id, capsule_id)
+        if capsule is None:
+            return jsonify({"error": CAPSULE_NOT_FOUND}), 404
+
+        locked = locked_open_payload(capsule, user_lat, user_lng)
+        if locked is not None:
+            return jsonify(locked), 200
+        return jsonify({"can_open": True, "capsule": with_media_urls(capsule)}), 200
+
+    except Exception as e:
+        logger.exception("Erro ao abrir cápsula")
+        return jsonify({"error": str(e)}), 500
+
+def load_spatial_index(user_id):
+    """ Cápsulas com localização do usuário, em páginas, para o índice espacial. """
+    capsules, cursor = [], None
+    while True:
+        query = supabase.table('capsules') \
+            .select(','.join(NEARBY_FIELDS)) \
+            .eq('user_id', user_id) \
+            .not_.is_('lat', 'null') \
+            .not_.is_('lng', 'null')
+        if cursor is not None:
+            query = query.gt('id', cursor)
+        page = query.order('id').limit(NEARBY_PAGE_SIZE).execute().data or []
+        capsules.extend(page)
+        if len(page) < NEARBY_PAGE_SIZE:
+            break
+        cursor = page[-1]['id']
+    return capsules
+
+def finite_query_float(args, name, default=None):
+    """
+    Número finito da query string, ou `default` se ausente. Lança ValueError
+    se o valor não for numérico ou for nan/inf (que passariam nas comparações
+    de faixa e quebrariam o índice espacial).
+    """
+    raw = args.get(name)
+    if raw is None or raw == '':
+        return default
+    try:
+        value = float(raw)
+    except ValueError:
+        raise ValueError(f"Parâmetro '{name}' deve ser numérico")
+    if not math.isfinite(value):
+        raise ValueError(f"Parâmetro '{name}' deve ser um número finito")
+    return value
+
+@app.route('/capsules/nearby', methods=['GET'])
+@jwt_required()
+def nearby_capsules():
+    try:
+        user_id = get_jwt_identity()
+        try:
+            user_lat = finite_query_float(request.args, 'lat')
+            user_lng = finite_query_float(request.args, 'lng')
+            radius = finite_query_float(request.args, 'radius', NEARBY_DEFAULT_RADIUS)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if user_lat is None or user_lng is None:
+            return jsonify({"error": "Parâmetros 'lat' e 'lng' são obrigatórios"}), 400
+        if not (-90 <= user_lat <= 90 and -180 <= user_lng <= 180):
+            return jsonify({"error": "Coordenadas inválidas"}), 400
+        if radius <= 0 or radius > NEARBY_MAX_RADIUS:
+            return jsonify({"error": f"O raio deve estar entre 0 e {NEARBY_MAX_RADIUS:.0f} metros"}), 400
+
+        spatial_index.ensure_user(user_id, lambda: load_spatial_index(user_id))
+
+        capsules = []
+        for capsule, distance in spatial_index.query(user_id, user_lat, user_lng, radius):
+            capsules.append({**capsule, "distance_m": round(distance, 1)})
+        return jsonify({"capsules": capsules}), 200
+    except Exception as e:
+        logger.exception("Erro ao buscar cápsulas próximas")
+        return jsonify({"error": str(e)}), 500
+
+EVENTS_UNAVAILABLE = "Eventos em tempo real indisponíveis neste servidor"
+
+@app.route('/capsules/events/token', methods=['POST'])
+@jwt_required()
+def capsule_events_token():
+    """ Token curto para abrir /capsules/events (501 se o stream está desligado). """
+    if not EVENTS_WSGI:
+        return jsonify({"error": EVENTS_UNAVAILABLE}), 501
+    return jsonify(event_stream_token_payload(get_jwt_identity())), 200
+
+@app.route('/capsules/events', methods=['GET'])
+def capsule_events():
+    """
+    Stream SSE com os eventos das cápsulas do usuário:
+      unlocked - a release_date chegou (a cápsula pode ser aberta)
+      notified - a cápsula física foi sinalizada ao dispositivo IoT
+      reset    - eventos foram perdidos; recarregue as cápsulas pela API
+    Reconexões com `Last-Event-ID` (ou `?lastEventId=`) recebem os eventos
+    perdidos. Autenticação: `?token=` com o token de POST /capsules/events/token.
+    No modo WSGI cada conexão ocupa uma thread e a rota responde 501 sem
+    EVENTS_WSGI=1; o navegador não reconecta e as telas seguem consultando a API.
+    """
+    if not EVENTS_WSGI:
+        return jsonify({"error": EVENTS_UNAVAILABLE}), 501
+
+    user_id, error = event_stream_identity(request.args, request.headers)
+    if error:
+        return jsonify({"msg": error[0]}), error[1]
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    subscription = event_broker.subscribe(user_id, last_event_id)
+    request_unlock_tracking(user_id, unlock_resume_since(subscription, last_event_id))
+
+    def stream():
+        try:
+            yield subscription.hello()
+            while True:
+                yield subscription.poll(EVENTS_HEARTBEAT_SECONDS)
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     R = 6371.0
     lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
@@ -0,0 +1,375 @@
+# Modo de execução assíncrono (ASGI)
+#
+# Uso: uvicorn asgi:application --host 0.0.0.0 --port 10000
+#
+# Com vários workers, desligue o agendador embutido (cada worker publicaria as
+# cápsulas físicas de novo) e libere em processo à parte:
+#   SCHEDULER_MODE=off uvicorn asgi:application --host 0.0.0.0 --port 10000 --workers 4
+#   python scheduler_worker.py
+#
+# As rotas mais acessadas são servidas por corrotinas (Quart) que usam o cliente
+# assíncrono do Supabase sobre um pool httpx compartilhado, então um worker não
+# fica preso durante cada ida ao PostgREST. As demais rotas continuam sendo
+# servidas pelo app Flask, adaptado para ASGI. Cache, índices, agendador e a
+# validação do JWT são os mesmos do modo WSGI.
+import asyncio
+import os
+import time
+from functools import wraps
+
+import httpx
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask_jwt_extended import decode_token
+from jwt import ExpiredSignatureError
+from quart import Quart, g, jsonify, make_response, request
+from quart_cors import cors
+from supabase import AsyncClientOptions, acreate_client
+
+from metrics import InstrumentedSupabase
+
+from app import (
+    app as flask_app,
+    CORS_ORIGINS,
+    HTTP_LATENCY,
+    CAPSULE_NOT_FOUND,
+    CAPSULE_NOT_OWNED,
+    CAPSULE_WITH_MEDIA_SELECT,
+    EVENTS_HEARTBEAT_SECONDS,
+    LIST_TIME_STATUSES,
+    MEDIA_BUCKET,
+    MEDIA_BUCKET_PRIVATE,
+    MEDIA_SIGNED_URL_TTL,
+    SSE_HEADERS,
+    apply_list_query,
+    attach_media_urls,
+    build_capsule_rows,
+    cached_media_urls,
+    capsule_cache,
+    check_media_inserted,
+    check_payload,
+    event_broker,
+    event_stream_identity,
+    event_stream_token_payload,
+    inserted_capsule_id,
+    list_cache_parts,
+    list_page_etag,
+    list_summary_query,
+    locked_open_payload,
+    logger,
+    login_credentials,
+    login_payload,
+    media_insert_rows,
+    media_paths,
+    parse_list_args,
+    prepare_list_response,
+    register_new_capsules,
+    remember_media_urls,
+    render_list_page,
+    request_coordinates,
+    request_unlock_tracking,
+    signed_media_urls,
+    unlock_resume_since,
+)
+
+# Pool de conexões compartilhado por todas as requisições do worker
+ASYNC_POOL_SIZE = int(os.getenv('ASYNC_POOL_SIZE', 100))
+ASYNC_POOL_KEEPALIVE = int(os.getenv('ASYNC_POOL_KEEPALIVE', 50))
+ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', 30))
+
+async_app = cors(
+    Quart(__name__),
+    allow_origin=CORS_ORIGINS,
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
+    allow_credentials=True,
+    max_age=3600
+)
+
+http_client = None
+supabase = None       # Consultas ao banco e ao Storage
+auth_supabase = None  # Login; separado para que a sessão do usuário não altere os cabeçalhos do `supabase`
+
+
+@async_app.before_serving
+async def startup():
+    global http_client, supabase, auth_supabase
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=ASYNC_POOL_SIZE,
+                            max_keepalive_connections=ASYNC_POOL_KEEPALIVE),
+        timeout=ASYNC_HTTP_TIMEOUT,
+        follow_redirects=True
+    )
+    options = dict(httpx_client=http_client, persist_session=False, auto_refresh_token=False)
+    supabase = InstrumentedSupabase(await acreate_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'),
+                                                         options=AsyncClientOptions(**options)))
+    auth_supabase = InstrumentedSupabase(await acreate_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'),
+                                                              options=AsyncClientOptions(**options)))
+
+
+@async_app.after_serving
+async def shutdown():
+    await http_client.aclose()
+
+
+@async_app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@async_app.after_request
+async def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_LATENCY.observe(time.perf_counter() - start, request.method, route, response.status_code)
+    return response
+
+
+def jwt_required_async(view):
+    """ Equivalente ao @jwt_required(): valida o token com a mesma configuração do app Flask. """
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer '):
+            return jsonify({"msg": "Missing Authorization Header"}), 401
+        try:
+            with flask_app.app_context():
+                claims = decode_token(header[len('Bearer '):])
+        except ExpiredSignatureError:
+            return jsonify({"msg": "Token has expired"}), 401
+        except Exception as e:
+            return jsonify({"msg": str(e)}), 422
+        g.user_id = claims[flask_app.config['JWT_IDENTITY_CLAIM']]
+        return await view(*args, **kwargs)
+    return wrapper
+
+
+async def resolve_media_urls(storage_paths):
+    """ Versão assíncrona de app.resolve_media_urls (mesmo cache de URLs). """
+    urls, missing = cached_media_urls(storage_paths)
+    if not missing:
+        return urls
+    bucket = supabase.storage.from_(MEDIA_BUCKET)
+    if MEDIA_BUCKET_PRIVATE:
+        remember_media_urls(urls, signed_media_urls(await bucket.create_signed_urls(missing, MEDIA_SIGNED_URL_TTL)))
+    else:
+        remember_media_urls(urls, [(path, await bucket.get_public_url(path)) for path in missing])
+    return urls
+
+
+async def fetch_capsule(user_id, capsule_id):
+    async def load():
+        response = await supabase.table('capsules') \
+                               .select(CAPSULE_WITH_MEDIA_SELECT) \
+                               .eq('id', capsule_id) \
+                               .eq('user_id', user_id) \
+                               .execute()
+        return response.data[0] if response.data else None
+
+    return await capsule_cache.aget_or_load(await capsule_cache.auser_key(user_id, 'capsule', capsule_id), load)
+
+
+async def with_media_urls(capsule):
+    return attach_media_urls(capsule, await resolve_media_urls(media_paths(capsule)))
+
+
+# --- ROTAS ASSÍNCRONAS ---
+
+@async_app.route('/login', methods=['POST'])
+async def login():
+    try:
+        try:
+            credentials = login_credentials(await request.get_json(force=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        auth_data = await auth_supabase.auth.sign_in_with_password(credentials)
+        with flask_app.app_context():
+            return jsonify(login_payload(auth_data.user.id)), 200
+    except Exception as e:
+        logger.exception("Erro no login")
+        return jsonify({"error": str(e)}), 401
+
+
+@async_app.route('/capsules', methods=['POST'])
+@jwt_required_async
+async def create_capsule():
+    try:
+        data = await request.get_json(force=True, silent=True)
+        current_user_id = g.user_id
+        try:
+            capsule_row, media_rows = build_capsule_rows(data, current_user_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        response_capsule = await supabase.table('capsules').insert(capsule_row).execute()
+        capsule_id = inserted_capsule_id(response_capsule)
+
+        if media_rows:
+            response_media = await supabase.table('capsule_media') \
+                                           .insert(media_insert_rows(media_rows, capsule_id)).execute()
+            check_media_inserted(response_media)
+    except Exception as e:
+        logger.exception("Erro na criação da cápsula")
+        if 'capsule_id' in locals():
+            await supabase.table('capsules').delete().eq('id', capsule_id).execute()
+            await capsule_cache.ainvalidate_user(current_user_id)
+        return jsonify({ "error": "Erro ao processar a requisição", "details": str(e) }), 500
+
+    # Fora do try: a cápsula já está gravada e não deve ser desfeita.
+    # Invalida o cache (ida ao Redis, se configurado) fora do event loop
+    await asyncio.to_thread(register_new_capsules, current_user_id, response_capsule.data)
+    return jsonify({ "status": "success", "capsule_id": capsule_id }), 201
+
+
+@async_app.route('/capsules', methods=['GET'])
+@jwt_required_async
+async def list_capsules():
+    try:
+        user_id = g.user_id
+        params, error = parse_list_args(request.args)
+        if error:
+            return jsonify({"error": error}), 400
+
+        async def load_page(etag=None):
+            query = supabase.table('capsules').select(params['select']).eq('user_id', user_id)
+            rows = (await apply_list_query(query, params).execute()).data or []
+            return render_list_page(rows, params['limit'], etag)
+
+        async def summary_etag():
+            return list_page_etag(await list_summary_query(supabase.table('capsules'), user_id).execute(), params)
+
+        async def load_cached_page():
+            return await load_page(await summary_etag())
+
+        parts = list_cache_parts(params)
+        if parts is not None:
+            key = await capsule_cache.auser_key(user_id, *parts)
+            body, etag = await capsule_cache.aget_or_load(key, load_cached_page)
+        elif params['status'] in LIST_TIME_STATUSES:
+            body, etag = await load_page()
+        else:
+            # Sem cache: o resumo decide o 304 antes de ler e serializar a página
+            etag = await summary_etag()
+            if request.if_none_match.contains(etag):
+                return prepare_list_response(async_app.response_class('', status=304), etag)
+            body, etag = await load_page(etag)
+
+        response = prepare_list_response(async_app.response_class(body, status=200, mimetype='application/json'),
+                                         etag)
+        return await response.make_conditional(request)
+    except Exception as e:
+        logger.exception("Erro ao listar cápsulas")
+        return jsonify({"error": str(e)}), 500
+
+
+@async_app.route('/capsules/<capsule_id>', methods=['GET'])
+@jwt_required_async
+async def get_capsule(capsule_id):
+    try:
+        capsule = await fetch_capsule(g.user_id, capsule_id)
+        if capsule is None:
+            return jsonify({"error": CAPSULE_NOT_OWNED}), 404
+        return jsonify(await with_media_urls(capsule)), 200
+    except Exception as e:
+        logger.exception("Erro ao buscar cápsula")
+        return jsonify({"error": "Erro interno do servidor", "details": str(e)}), 500
+
+
+@async_app.route('/capsules/<capsule_id>/check', methods=['GET'])
+@jwt_required_async
+async def check_capsule(capsule_id):
+    try:
+        user_lat, user_lng = request_coordinates(request.args)
+
+        capsule = await fetch_capsule(g.user_id, capsule_id)
+        if capsule is None:
+            return jsonify({"error": CAPSULE_NOT_FOUND}), 404
+        return jsonify(check_payload(capsule, user_lat, user_lng)), 200
+    except Exception as e:
+        logger.exception("Erro ao checar cápsula")
+        return jsonify({"error": str(e)}), 500
+
+
+@async_app.route('/capsules/<capsule_id>/open', methods=['GET'])
+@jwt_required_async
+async def open_capsule(capsule_id):
+    try:
+        user_lat, user_lng = request_coordinates(request.args)
+
+        capsule = await fetch_capsule(g.user_id, capsule_id)
+        if capsule is None:
+            return jsonify({"error": CAPSULE_NOT_FOUND}), 404
+
+        locked = locked_open_payload(capsule, user_lat, user_lng)
+        if locked is not None:
+            return jsonify(locked), 200
+        return jsonify({"can_open": True, "capsule": await with_media_urls(capsule)}), 200
+    except Exception as e:
+        logger.exception("Erro ao abrir cápsula")
+        return jsonify({"error": str(e)}), 500
+
+
+@async_app.route('/capsules/events/token', methods=['POST'])
+@jwt_required_async
+async def capsule_events_token():
+    """ Token curto para abrir /capsules/events (ver app.event_stream_token_payload). """
+    return jsonify(event_stream_token_payload(g.user_id)), 200
+
+
+@async_app.route('/capsules/events', methods=['GET'])
+async def capsule_events():
+    """ Stream SSE (ver app.capsule_events): uma corrotina por conexão, sem thread dedicada. """
+    with flask_app.app_context():
+        user_id, error = event_stream_identity(request.args, request.headers)
+    if error:
+        return jsonify({"msg": error[0]}), error[1]
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    subscription = event_broker.subscribe(user_id, last_event_id, loop=asyncio.get_running_loop())
+    request_unlock_tracking(user_id, unlock_resume_since(subscription, last_event_id))
+
+    async def stream():
+        try:
+            yield subscription.hello()
+            while True:
+                yield await subscription.apoll(EVENTS_HEARTBEAT_SECONDS)
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    response = await make_response(stream(), 200, {**SSE_HEADERS, 'Content-Type': 'text/event-stream'})
+    response.timeout = None  # Conexão longa: sem o limite padrão de resposta do Quart
+    return response
+
+
+# --- DESPACHO ---
+
+class _PooledWsgiInstance(WsgiToAsgiInstance):
+    # O padrão do asgiref (thread_sensitive=True) executa todas as requisições
+    # do Flask em uma única thread; aqui cada uma vai para o pool de threads.
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _PooledWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+flask_asgi = PooledWsgiToAsgi(flask_app)
+# A tabela de rotas do Flask é a completa; uma requisição vai para o Quart só se
+# a rota casada lá tiver versão assíncrona (ex.: /capsules/nearby não pode cair
+# em /capsules/<capsule_id> do Quart).
+_flask_routes = flask_app.url_map.bind('localhost')
+_async_endpoints = {rule.endpoint for rule in async_app.url_map.iter_rules()} - {'static'}
+
+
+async def application(scope, receive, send):
+    """ Rotas assíncronas vão para o Quart; as demais, para o app Flask. """
+    if scope['type'] == 'http':
+        try:
+            endpoint, _ = _flask_routes.match(scope['path'], method=scope['method'])
+        except Exception:
+            endpoint = None
+        if endpoint not in _async_endpoints:
+            return await flask_asgi(scope, receive, send)
+    await async_app(scope, receive, send)
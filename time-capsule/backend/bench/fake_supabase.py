@@ -0,0 +1,416 @@
+# Substituto local do Supabase para os benchmarks: PostgREST, Storage e Auth em memória
+#
+# Implementa apenas o subconjunto da API usado pelo backend (filtros eq/neq/gt/
+# gte/lt/lte/in/is, `not.`, `or=(...)` com `and(...)`, order, limit, embed de
+# `capsule_media`, contagem com `Prefer: count=exact`, insert/update/delete e as
+# funções RPC), com uma latência configurável por requisição para simular a ida
+# e volta ao serviço hospedado.
+import json
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import httpx
+
+
+def _split_top_level(text):
+    """ Divide por vírgulas que não estão dentro de parênteses. """
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    if current:
+        parts.append(current)
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _as_text(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _compare(stored, raw):
+    """ Compara como número quando possível; caso contrário, como texto (datas ISO ordenam bem). """
+    if stored is None:
+        return None
+    try:
+        return (float(stored) > float(raw)) - (float(stored) < float(raw))
+    except (TypeError, ValueError):
+        text = _as_text(stored)
+        return (text > raw) - (text < raw)
+
+
+def _unquote_value(raw):
+    return raw[1:-1].replace('\\"', '"') if len(raw) >= 2 and raw[0] == raw[-1] == '"' else raw
+
+
+def _condition(column, expression):
+    """ Compila `op.valor` (com `not.` opcional) em um predicado sobre a linha. """
+    negate = expression.startswith('not.')
+    if negate:
+        expression = expression[4:]
+    op, _, raw = expression.partition('.')
+    raw = _unquote_value(raw)
+
+    if op == 'eq':
+        test = lambda row: _as_text(row.get(column)) == raw
+    elif op == 'neq':
+        test = lambda row: _as_text(row.get(column)) != raw
+    elif op in ('gt', 'gte', 'lt', 'lte'):
+        accept = {'gt': (1,), 'gte': (0, 1), 'lt': (-1,), 'lte': (-1, 0)}[op]
+        test = lambda row: _compare(row.get(column), raw) in accept
+    elif op == 'in':
+        values = {_unquote_value(v.strip()) for v in _split_top_level(raw.strip('()'))}
+        test = lambda row: _as_text(row.get(column)) in values
+    elif op == 'is':
+        test = lambda row: _as_text(row.get(column)) == raw
+    else:
+        raise ValueError(f"Operador não suportado: {op}")
+    return (lambda row: not test(row)) if negate else test
+
+
+def _logic(expression):
+    """ Compila `or=(a.op.v,and(b.op.v,...))` em um predicado. """
+    combinator, _, body = expression.partition('(')
+    terms = []
+    for term in _split_top_level(body[:-1]):
+        if term.startswith(('and(', 'or(')):
+            terms.append(_logic(term))
+        else:
+            column, _, rest = term.partition('.')
+            terms.append(_condition(column, rest))
+    if combinator == 'and':
+        return lambda row: all(t(row) for t in terms)
+    return lambda row: any(t(row) for t in terms)
+
+
+class _Server(ThreadingHTTPServer):
+    # O padrão (5) descarta conexões em rajadas; o SYN reenviado custa segundos ao cliente
+    request_queue_size = 1024
+
+
+class FakeSupabase:
+    """
+    Banco em memória com as tabelas `capsules` e `capsule_media`, servido por
+    HTTP em uma thread. `latency` (segundos) é aplicada a cada requisição, com
+    `jitter` relativo opcional.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tables = {'capsules': [], 'capsule_media': []}
+        self.rpcs = {'bulk_create_capsules': self._rpc_bulk_create,
+                     'claim_due_capsules': self._rpc_claim_due}
+        self.lock = threading.Lock()
+        self._server = _Server((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-supabase", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # --- Dados ---
+
+    def insert(self, table, rows):
+        now = datetime.now().isoformat()
+        created = []
+        with self.lock:
+            for row in rows:
+                row = dict(row)
+                row.setdefault('id', str(uuid.uuid4()))
+                if table == 'capsules':
+                    row.setdefault('created_at', now)
+                    row.setdefault('notificacao_enviada', False)
+                    for column in ('message', 'image_url', 'lat', 'lng', 'tipo', 'release_date', 'user_id',
+                                   'claimed_by', 'claimed_until'):
+                        row.setdefault(column, None)
+                self.tables[table].append(row)
+                created.append(dict(row))
+        return created
+
+    def select(self, table, predicates=(), order=(), limit=None, columns=None, with_count=False):
+        """ Linhas filtradas; com `with_count`, retorna (linhas, total antes do limit). """
+        with self.lock:
+            rows = [row for row in self.tables[table] if all(p(row) for p in predicates)]
+            total = len(rows)
+            for column, desc in reversed(order):
+                rows.sort(key=lambda r: (r.get(column) is None, _as_text(r.get(column))), reverse=desc)
+            if limit is not None:
+                rows = rows[:limit]
+            rows = [self._project(table, row, columns) for row in rows]
+            return (rows, total) if with_count else rows
+
+    def update(self, table, predicates, values):
+        with self.lock:
+            updated = []
+            for row in self.tables[table]:
+                if all(p(row) for p in predicates):
+                    row.update(values)
+                    updated.append(dict(row))
+            return updated
+
+    def delete(self, table, predicates):
+        with self.lock:
+            kept, removed = [], []
+            for row in self.tables[table]:
+                (removed if all(p(row) for p in predicates) else kept).append(row)
+            self.tables[table] = kept
+            if table == 'capsules' and removed:
+                ids = {row['id'] for row in removed}
+                self.tables['capsule_media'] = [m for m in self.tables['capsule_media']
+                                                if m.get('capsule_id') not in ids]
+            return removed
+
+    def _project(self, table, row, columns):
+        if not columns:
+            return dict(row)
+        result = {}
+        for column in columns:
+            if column == '*':
+                result.update(row)
+            elif column.endswith(')'):
+                name, _, inner = column.partition('(')
+                fields = _split_top_level(inner[:-1])
+                media = [m for m in self.tables[name] if m.get('capsule_id') == row['id']]
+                result[name] = [{f: m.get(f) for f in fields} if '*' not in fields else dict(m) for m in media]
+            else:
+                result[column] = row.get(column)
+        return result
+
+    def _rpc_bulk_create(self, params):
+        rows = params['p_rows']
+        created = self.insert('capsules', [r['capsule'] for r in rows])
+        for capsule, row in zip(created, rows):
+            media = row.get('media') or []
+            self.insert('capsule_media', [{**m, 'capsule_id': capsule['id']} for m in media])
+        return created
+
+    def _rpc_claim_due(self, params):
+        """ Mesma semântica de sql/claim_due_capsules.sql; o lock faz o papel do SKIP LOCKED. """
+        now = datetime.now(timezone.utc)
+        claimed_until = (now + timedelta(seconds=params.get('p_lease_seconds', 120))).isoformat()
+        with self.lock:
+            due = [row for row in self.tables['capsules']
+                   if row.get('tipo') == 'fisica' and not row.get('notificacao_enviada')
+                   and _compare(row.get('release_date'), params['p_now']) in (-1, 0)
+                   and (row.get('claimed_until') is None or row['claimed_until'] < now.isoformat())]
+            due.sort(key=lambda row: row['release_date'])
+            claimed = []
+            for row in due[:params.get('p_limit', 500)]:
+                row['claimed_by'] = params['p_worker']
+                row['claimed_until'] = claimed_until
+                claimed.append(dict(row))
+            return claimed
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter))))
+
+
+def _make_handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True  # Cabeçalho e corpo saem em escritas separadas
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body=None):
+            payload = b'' if body is None else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in self.extra_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length)) if length else None
+
+        def _handle(self, method):
+            body = self._body() if method in ('POST', 'PATCH') else None
+            self.extra_headers = {}  # A conexão (keep-alive) reaproveita o handler
+            fake._sleep()
+            parts = urlsplit(self.path)
+            try:
+                status, payload = self._dispatch(method, parts.path, parse_qsl(parts.query, keep_blank_values=True), body)
+            except Exception as e:
+                status, payload = 400, {"code": "BENCH", "message": str(e), "details": None, "hint": None}
+            self._send(status, payload)
+
+        def _dispatch(self, method, path, query, body):
+            if path.startswith('/rest/v1/rpc/'):
+                name = path[len('/rest/v1/rpc/'):]
+                if name not in fake.rpcs:
+                    return 404, {"code": "PGRST202", "message": f"Could not find the function {name}",
+                                 "details": None, "hint": None}
+                return 200, fake.rpcs[name](body or {})
+            if path.startswith('/rest/v1/'):
+                return self._rest(method, path[len('/rest/v1/'):], query, body)
+            if path.startswith('/auth/v1/token'):
+                return 200, _session(body or {})
+            if path.startswith('/storage/v1/object/sign/'):
+                bucket = path[len('/storage/v1/object/sign/'):]
+                return 200, [{"error": None, "path": p, "signedURL": f"/object/sign/{bucket}/{p}?token=bench"}
+                             for p in (body or {}).get('paths', [])]
+            return 404, {"message": f"Rota não simulada: {path}"}
+
+        def _rest(self, method, table, query, body):
+            predicates, order, limit, columns = [], [], None, None
+            for key, value in query:
+                if key == 'select':
+                    columns = _split_top_level(unquote(value).replace(' ', ''))
+                elif key == 'order':
+                    for item in value.split(','):
+                        column, _, direction = item.partition('.')
+                        order.append((column, direction.startswith('desc')))
+                elif key == 'limit':
+                    limit = int(value)
+                elif key in ('or', 'and'):
+                    predicates.append(_logic(f"{key}{value}"))
+                elif key not in ('offset', 'columns', 'on_conflict'):
+                    predicates.append(_condition(key, value))
+
+            if method == 'GET':
+                if 'count=exact' not in (self.headers.get('Prefer') or ''):
+                    return 200, fake.select(table, predicates, order, limit, columns)
+                rows, total = fake.select(table, predicates, order, limit, columns, with_count=True)
+                self.extra_headers = {'Content-Range': f"0-{max(len(rows) - 1, 0)}/{total}"}
+                return 200, rows
+            if method == 'POST':
+                return 201, fake.insert(table, body if isinstance(body, list) else [body])
+            if method == 'PATCH':
+                return 200, fake.update(table, predicates, body or {})
+            if method == 'DELETE':
+                return 200, fake.delete(table, predicates)
+            return 405, {"message": method}
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_PATCH(self):
+            self._handle('PATCH')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+        def do_HEAD(self):
+            self._handle('GET')
+
+    return Handler
+
+
+def _serve_in_child(conn, latency, jitter):
+    server = FakeSupabase(latency=latency, jitter=jitter).start()
+    conn.send(server.url)
+    threading.Event().wait()
+
+
+class FakeSupabaseProcess:
+    """
+    O mesmo servidor em um processo separado, para não disputar o GIL com o
+    gerador de carga. Os dados são semeados e lidos pela própria API REST.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.url = None
+        self._process = None
+        self._http = None
+
+    def start(self):
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve_in_child, args=(child, self.latency, self.jitter),
+                                                name="fake-supabase", daemon=True)
+        self._process.start()
+        self.url = parent.recv()
+        self._http = httpx.Client(base_url=f"{self.url}/rest/v1", timeout=120)
+        return self
+
+    def stop(self):
+        self._http.close()
+        self._process.terminate()
+        self._process.join(timeout=5)
+
+    def insert(self, table, rows, chunk=5000):
+        for i in range(0, len(rows), chunk):
+            self._http.post(f"/{table}", json=rows[i:i + chunk]).raise_for_status()
+
+    def rows(self, table, **filters):
+        params = {"select": "*", **{column: f"eq.{value}" for column, value in filters.items()}}
+        response = self._http.get(f"/{table}", params=params)
+        response.raise_for_status()
+        return response.json()
+
+
+def user_id_for(email):
+    """ IDs de usuário determinísticos, para que o mesmo email sempre mapeie para o mesmo usuário. """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"bench:{email}"))
+
+
+def _session(credentials):
+    email = credentials.get('email', 'bench@example.com')
+    now = int(time.time())
+    return {
+        "access_token": f"bench-{uuid.uuid4().hex}",
+        "refresh_token": uuid.uuid4().hex,
+        "token_type": "bearer",
+        "expires_in": 3600,
+        "expires_at": now + 3600,
+        "user": {
+            "id": user_id_for(email),
+            "aud": "authenticated",
+            "role": "authenticated",
+            "email": email,
+            "app_metadata": {"provider": "email"},
+            "user_metadata": {},
+            "created_at": datetime.now().isoformat(),
+        },
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Supabase falso (PostgREST/Storage/Auth) em memória")
+    parser.add_argument('--port', type=int, default=54321)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeSupabase(port=args.port, latency=args.latency_ms / 1000).start()
+    print(f"Supabase falso em {server.url} (SUPABASE_URL={server.url} SUPABASE_KEY=bench)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,169 @@
+# Broker MQTT mínimo para os benchmarks (MQTT 3.1.1 e 5, QoS 0 e 1)
+#
+# Aceita conexões, confirma publicações com PUBACK (com atraso opcional, para
+# simular um broker remoto) e registra cada mensagem recebida com o instante de
+# chegada. Não faz roteamento para assinantes: o objetivo é medir o publicador.
+import asyncio
+import json
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 12, 13, 14
+
+
+async def _read_packet(reader):
+    first = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+
+def _varint_length(data, offset):
+    """ Lê um inteiro de tamanho variável (propriedades do MQTT 5). Retorna (valor, novo offset). """
+    value, multiplier = 0, 1
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, offset
+        multiplier *= 128
+
+
+class MqttBroker:
+    """
+    Broker em uma thread com event loop próprio. `messages` guarda
+    (recebida_em, tópico, payload) na ordem de chegada.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, ack_delay=0.0):
+        self.host = host
+        self.port = port
+        self.ack_delay = ack_delay
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._tasks = set()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mqtt-broker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+    async def _shutdown(self):
+        self._server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def clear(self):
+        with self._lock:
+            self.messages = []
+
+    def received(self):
+        with self._lock:
+            return list(self.messages)
+
+    def payloads(self):
+        """ Payloads recebidos, decodificados como JSON quando possível. """
+        decoded = []
+        for _, _, payload in self.received():
+            try:
+                decoded.append(json.loads(payload))
+            except ValueError:
+                decoded.append(payload)
+        return decoded
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._serve, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.connections += 1
+        version = 4
+        try:
+            while True:
+                kind, flags, body = await _read_packet(reader)
+                if kind == CONNECT:
+                    name_length = int.from_bytes(body[0:2], 'big')
+                    version = body[2 + name_length]
+                    writer.write(bytes([CONNACK << 4, 3, 0, 0, 0]) if version == 5 else bytes([CONNACK << 4, 2, 0, 0]))
+                elif kind == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = int.from_bytes(body[0:2], 'big')
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    packet_id = None
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                    if version == 5:
+                        properties_length, offset = _varint_length(body, offset)
+                        offset += properties_length
+                    with self._lock:
+                        self.messages.append((time.time(), topic, body[offset:]))
+                    if qos == 1:
+                        if self.ack_delay:
+                            self._loop.call_later(self.ack_delay, writer.write, bytes([PUBACK << 4, 2]) + packet_id)
+                        else:
+                            writer.write(bytes([PUBACK << 4, 2]) + packet_id)
+                elif kind == SUBSCRIBE:
+                    # Só confirma (QoS 0 concedido); não há roteamento
+                    offset, granted = 2, 0
+                    if version == 5:
+                        properties_length, offset = _varint_length(body, offset)
+                        offset += properties_length
+                    while offset < len(body):
+                        offset += 2 + int.from_bytes(body[offset:offset + 2], 'big') + 1
+                        granted += 1
+                    header = b'\x00' if version == 5 else b''
+                    writer.write(bytes([SUBACK << 4, 2 + len(header) + granted]) + body[0:2] + header + bytes(granted))
+                elif kind == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+            self._tasks.discard(task)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Broker MQTT mínimo para testes locais")
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--ack-delay-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    broker = MqttBroker(port=args.port, ack_delay=args.ack_delay_ms / 1000).start()
+    print(f"Broker MQTT em {broker.host}:{broker.port} (MQTT_BROKER_URL={broker.host} MQTT_PORT={broker.port} MQTT_TLS=0)")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"{len(broker.received())} mensagens recebidas")
+    except KeyboardInterrupt:
+        broker.stop()
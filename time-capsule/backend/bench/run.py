@@ -0,0 +1,889 @@
+# Suíte de carga e benchmarks do backend
+#
+# Uso (a partir de backend/):
+#   python -m bench.run                                  # todos os cenários, modo WSGI
+#   python -m bench.run --server wsgi,asgi --scenarios login,list_10k
+#   python -m bench.run --output resultados.json --baseline bench/baseline.json
+#
+# Cada cenário sobe o backend real em um subprocesso apontado para o Supabase
+# falso (bench/fake_supabase.py) e para o broker MQTT local (bench/mqtt_broker.py),
+# que rodam neste processo. Os resultados trazem vazão e latências p50/p95/p99 e
+# podem ser comparados com uma linha de base salva para apontar regressões.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+import numpy as np
+
+from bench.fake_supabase import FakeSupabaseProcess, user_id_for
+from bench.mqtt_broker import MqttBroker
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cenários que não usam o servidor web: rodam uma única vez mesmo com --server wsgi,asgi
+SERVERLESS_SCENARIOS = ('expiry_scaling',)
+SCENARIOS = ('login', 'create', 'bulk', 'list_10k', 'list_10k_cached', 'open', 'open_cached', 'nearby', 'expiry',
+             'expiry_scaling', 'events')
+ORIGIN = (-22.9068, -43.1729)  # Pontos gerados em volta do Rio de Janeiro
+
+
+# --- Processo do backend ---
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Backend:
+    """
+    O backend em um subprocesso: gunicorn/flask (wsgi), uvicorn (asgi) ou só o
+    processo de liberação (scheduler, com /metrics para saber quando está pronto).
+    """
+
+    def __init__(self, server, workers, env, log_dir):
+        self.server = server
+        self.workers = workers
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = {**os.environ, **env}
+        self.log_path = os.path.join(log_dir, f"backend-{self.port}.log")
+        self.process = None
+
+    def command(self):
+        bind = ['127.0.0.1', str(self.port)]
+        if self.server == 'scheduler':
+            return [sys.executable, 'scheduler_worker.py', '--metrics-port', bind[1]]
+        if self.server == 'asgi':
+            return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', bind[0], '--port', bind[1],
+                    '--workers', str(self.workers), '--log-level', 'warning', '--no-access-log']
+        if shutil.which('gunicorn'):
+            return ['gunicorn', 'app:app', '-b', ':'.join(bind), '-w', str(self.workers),
+                    '--threads', '16', '--log-level', 'warning']
+        # Sem gunicorn: servidor do Werkzeug com threads (um único processo)
+        return [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--host', bind[0], '--port', bind[1],
+                '--with-threads', '--no-reload', '--no-debugger']
+
+    def start(self, timeout=60):
+        self.log = open(self.log_path, 'w')
+        self.process = subprocess.Popen(self.command(), cwd=BACKEND_DIR, env=self.env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                ready_path = '/metrics' if self.server == 'scheduler' else '/cache/stats'
+                if httpx.get(f"{self.url}{ready_path}", timeout=1).status_code == 200:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        with open(self.log_path) as log:
+            tail = log.read()[-3000:]
+        raise RuntimeError(f"O backend não respondeu em {timeout}s:\n{tail}")
+
+    def rss_bytes(self):
+        """ Memória residente do backend (processo e filhos, ex.: workers do uvicorn). """
+        total, pending = 0, [self.process.pid]
+        while pending:
+            pid = pending.pop()
+            try:
+                with open(f"/proc/{pid}/status") as status:
+                    total += next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmRSS:'))
+                for task in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{task}/children") as children:
+                        pending.extend(int(child) for child in children.read().split())
+            except (OSError, StopIteration):
+                pass
+        return total
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if getattr(self, 'log', None):
+            self.log.close()
+
+
+# --- Geração de carga ---
+
+def summarize(name, latencies, errors, elapsed, statuses=None, unit='requests', **extra):
+    latencies_ms = np.asarray(latencies, dtype=float) * 1000.0
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]) if len(latencies_ms) else (0.0, 0.0, 0.0)
+    return {
+        "scenario": name,
+        unit: len(latencies) + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "throughput_unit": f"{unit}/s",
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "mean_ms": round(float(latencies_ms.mean()), 2) if len(latencies_ms) else 0.0,
+        **({"statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)}} if statuses else {}),
+        **extra
+    }
+
+
+async def _drive(url, requests, concurrency, timeout=60.0, sizes=None):
+    """
+    Executa as requisições (method, path, kwargs) com `concurrency` clientes.
+    Retorna (latências dos sucessos, erros, duração total, respostas por status).
+    Com `sizes` (lista), acrescenta nela o tamanho do corpo de cada sucesso.
+    """
+    latencies, statuses, errors = [], {}, 0
+    queue = iter(requests)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def worker(client):
+        nonlocal errors
+        for method, path, kwargs in queue:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 'erro'
+            elapsed = time.perf_counter() - start
+            statuses[status] = statuses.get(status, 0) + 1
+            if isinstance(status, int) and status < 400:
+                latencies.append(elapsed)
+                if sizes is not None:
+                    sizes.append(len(response.content))
+            else:
+                errors += 1
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed, statuses
+
+
+def drive(url, requests, concurrency, sizes=None):
+    return asyncio.run(_drive(url, requests, concurrency, sizes=sizes))
+
+
+def summarize_sized(name, url, requests, concurrency):
+    """ Como summarize(drive(...)), com o tamanho médio do corpo das respostas (`bytes_per_response`). """
+    sizes = []
+    result = summarize(name, *drive(url, requests, concurrency, sizes=sizes))
+    result["bytes_per_response"] = round(sum(sizes) / len(sizes)) if sizes else 0
+    return result
+
+
+def login(url, emails):
+    """ Faz login de cada email e retorna {email: cabeçalhos com o token}. """
+    headers = {}
+    for email in emails:
+        response = httpx.post(f"{url}/login", json={"email": email, "password": "bench"}, timeout=30)
+        response.raise_for_status()
+        headers[email] = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    return headers
+
+
+def mint_tokens(user_ids, secret):
+    """ Tokens de acesso iguais aos do /login, gerados localmente (sem uma ida ao Auth por usuário). """
+    from flask import Flask
+    from flask_jwt_extended import JWTManager, create_access_token
+
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = secret
+    JWTManager(app)
+    with app.app_context():
+        return {user_id: create_access_token(identity=user_id) for user_id in user_ids}
+
+
+class SseClient:
+    """
+    Cliente SSE mínimo sobre asyncio (HTTP/1.0, sem chunked), para abrir
+    milhares de conexões a partir de um único processo. `events` guarda
+    (recebido_em, evento, id, dados) de cada frame. Cada conexão pede antes um
+    token de stream com o token de acesso, como o frontend.
+    """
+
+    def __init__(self, url, token, http):
+        self.host, self.port = url.rsplit('/', 1)[-1].split(':')
+        self.token = token
+        self.http = http
+        self.events = []
+        self.ready = asyncio.Event()
+        self.resume_id = None
+        self._task = None
+        self._writer = None
+
+    async def connect(self, last_event_id=None):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        try:
+            response = await self.http.post('/capsules/events/token', headers=headers)
+        except httpx.RemoteProtocolError:
+            # Conexão keep-alive fechada pelo servidor ao ser reaproveitada; o
+            # navegador repete nesse caso, então repetimos uma vez.
+            response = await self.http.post('/capsules/events/token', headers=headers)
+        response.raise_for_status()
+        stream_token = response.json()['token']
+        reader, self._writer = await asyncio.open_connection(self.host, int(self.port))
+        request = f"GET /capsules/events?token={stream_token} HTTP/1.0\r\nHost: {self.host}\r\nAccept: text/event-stream\r\n"
+        if last_event_id:
+            request += f"Last-Event-ID: {last_event_id}\r\n"
+        self._writer.write((request + "\r\n").encode())
+        status = await reader.readline()
+        if b' 200 ' not in status:
+            raise ConnectionError(status.decode(errors='replace').strip())
+        while (await reader.readline()).strip():
+            pass
+        self.ready.clear()
+        self._task = asyncio.ensure_future(self._read(reader))
+
+    async def _read(self, reader):
+        fields = {}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                line = line.decode().rstrip('\r\n')
+                if line:
+                    name, _, value = line.partition(':')
+                    fields[name] = value.lstrip(' ')
+                    continue
+                if 'event' in fields:
+                    self.events.append((time.time(), fields['event'], fields.get('id'), json.loads(fields.get('data') or '{}')))
+                    if fields['event'] == 'ready':
+                        self.resume_id = fields.get('id')
+                        self.ready.set()
+                fields = {}
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def received(self, event_type):
+        return [(ts, data) for ts, kind, _, data in self.events if kind == event_type]
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+# --- Dados sintéticos ---
+
+def capsule_row(email, index, release, tipo='digital', with_media=False, rng=random):
+    lat = ORIGIN[0] + rng.uniform(-0.05, 0.05)
+    lng = ORIGIN[1] + rng.uniform(-0.05, 0.05)
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id_for(email),
+        "message": f"Cápsula {index}",
+        "release_date": release.isoformat(timespec='seconds'),
+        "created_at": (datetime.now() - timedelta(seconds=index)).isoformat(),
+        "lat": round(lat, 6),
+        "lng": round(lng, 6),
+        "tipo": tipo,
+        "notificacao_enviada": False,
+        "image_url": None,
+    }, ([{"storage_path": f"{email}/{index}.jpg", "media_type": "image"}] if with_media else [])
+
+
+def seed(fake, rows):
+    fake.insert('capsules', [capsule for capsule, _ in rows])
+    media = [{**m, "capsule_id": capsule['id']} for capsule, media_rows in rows for m in media_rows]
+    if media:
+        fake.insert('capsule_media', media)
+
+
+# --- Cenários ---
+# Cada cenário recebe o contexto e devolve uma lista de resultados.
+
+def scenario_login(ctx):
+    """ Tempestade de logins: muitos usuários autenticando ao mesmo tempo. """
+    n = ctx.count(2000)
+    with ctx.backend() as backend:
+        requests = [('POST', '/login', {"json": {"email": f"user{i % 500}@bench.local", "password": "bench"}})
+                    for i in range(n)]
+        return [summarize('login', *drive(backend.url, requests, ctx.concurrency))]
+
+
+def scenario_create(ctx):
+    """ Rajada de criação de cápsulas (digitais e físicas, metade com mídia). """
+    n = ctx.count(2000)
+    emails = [f"user{i}@bench.local" for i in range(20)]
+    release = datetime.now() + timedelta(days=30)
+    with ctx.backend() as backend:
+        headers = login(backend.url, emails)
+        requests = []
+        for i in range(n):
+            body = {
+                "message": f"Cápsula {i}",
+                "open_date": release.isoformat(timespec='minutes'),
+                "tipo": 'fisica' if i % 5 == 0 else 'digital',
+                "lat": ORIGIN[0], "lng": ORIGIN[1],
+                "media_files": [{"storage_path": f"bench/{i}.jpg", "media_type": "image"}] if i % 2 else [],
+            }
+            requests.append(('POST', '/capsules', {"json": body, "headers": headers[emails[i % len(emails)]]}))
+        return [summarize('create', *drive(backend.url, requests, ctx.concurrency))]
+
+
+def scenario_bulk(ctx):
+    """ Importação em lote (NDJSON) de vários milhares de cápsulas por requisição. """
+    rows, batches = ctx.count(5000), 5
+    email = "bulk@bench.local"
+    release = (datetime.now() + timedelta(days=30)).isoformat(timespec='minutes')
+    body = "\n".join(json.dumps({"message": f"Lote {i}", "open_date": release, "tipo": "digital"})
+                     for i in range(rows))
+    with ctx.backend() as backend:
+        headers = {**login(backend.url, [email])[email], "Content-Type": "application/x-ndjson"}
+        requests = [('POST', '/capsules/bulk', {"content": body, "headers": headers})] * batches
+        result = summarize('bulk', *drive(backend.url, requests, 1))
+    result.update(rows_per_request=rows, rows_per_s=round(rows * result['throughput'], 1))
+    return [result]
+
+
+def scenario_list_10k(ctx, env=None, workers=None):
+    """
+    Dashboard de um usuário com 10 mil cápsulas: primeira página repetida,
+    varredura por cursor e listagem completa (sem `limit`), cada uma também
+    revalidada com If-None-Match (caminho 304). Reporta bytes por resposta.
+    """
+    total = ctx.count(10000)
+    emails = [f"dash{i}@bench.local" for i in range(4)]
+    rng = random.Random(11)
+    now = datetime.now()
+    for email in emails:
+        seed(ctx.fake, [capsule_row(email, i, now + timedelta(hours=rng.randint(-500, 500)), rng=rng)
+                        for i in range(total)])
+
+    results = []
+    with ctx.backend(env=env, workers=workers) as backend:
+        headers = login(backend.url, emails)
+
+        def revalidated(requests):
+            """ As mesmas requisições com If-None-Match do ETag atual (o servidor deve responder 304). """
+            etags, revalidating = {}, []
+            for method, path, kwargs in requests:
+                key = (path, json.dumps(kwargs.get("params")), kwargs["headers"]["Authorization"])
+                if key not in etags:
+                    etags[key] = httpx.get(f"{backend.url}{path}", timeout=60, **kwargs).headers['ETag']
+                headers = {**kwargs["headers"], "If-None-Match": etags[key]}
+                revalidating.append((method, path, {**kwargs, "headers": headers}))
+            return revalidating
+
+        requests = [('GET', '/capsules', {"params": {"limit": 24}, "headers": headers[emails[i % len(emails)]]})
+                    for i in range(ctx.count(1000))]
+        results.append(summarize_sized('list_10k_first_page', backend.url, requests, ctx.concurrency))
+        results.append(summarize_sized('list_10k_first_page_304', backend.url, revalidated(requests),
+                                       ctx.concurrency))
+
+        walked_bytes = []
+
+        async def walk(email):
+            """ Percorre todas as páginas seguindo next_cursor. """
+            latencies, cursor = [], None
+            async with httpx.AsyncClient(base_url=backend.url, timeout=60) as client:
+                while True:
+                    params = {"limit": 100, **({"cursor": cursor} if cursor else {})}
+                    start = time.perf_counter()
+                    response = await client.get('/capsules', params=params, headers=headers[email])
+                    latencies.append(time.perf_counter() - start)
+                    response.raise_for_status()
+                    walked_bytes.append(len(response.content))
+                    cursor = response.json()['next_cursor']
+                    if not cursor:
+                        return latencies
+
+        async def walk_all():
+            start = time.perf_counter()
+            pages = await asyncio.gather(*(walk(email) for email in emails))
+            return [l for page in pages for l in page], time.perf_counter() - start
+
+        latencies, elapsed = asyncio.run(walk_all())
+        results.append(summarize('list_10k_walk', latencies, 0, elapsed,
+                                 bytes_per_response=round(sum(walked_bytes) / len(walked_bytes))))
+
+        requests = [('GET', '/capsules', {"headers": headers[emails[i % len(emails)]]})
+                    for i in range(ctx.count(40))]
+        results.append(summarize_sized('list_10k_full', backend.url, requests, min(ctx.concurrency, 8)))
+        results.append(summarize_sized('list_10k_full_304', backend.url, revalidated(requests),
+                                       min(ctx.concurrency, 8)))
+    return results
+
+
+def scenario_open(ctx, env=None, workers=None):
+    """ Abertura de cápsulas (/open e /check) sobre IDs aleatórios, metade já liberada. """
+    emails = [f"open{i}@bench.local" for i in range(50)]
+    rng = random.Random(7)
+    now = datetime.now()
+    rows = [capsule_row(email, i, now + timedelta(days=rng.choice([-1, 1])), with_media=True, rng=rng)
+            for email in emails for i in range(40)]
+    seed(ctx.fake, rows)
+
+    with ctx.backend(env=env, workers=workers) as backend:
+        headers = login(backend.url, emails)
+        requests = []
+        for i in range(ctx.count(3000)):
+            capsule, _ = rng.choice(rows)
+            email = next(e for e in emails if user_id_for(e) == capsule['user_id'])
+            path = f"/capsules/{capsule['id']}/{'open' if i % 2 else 'check'}"
+            requests.append(('GET', path, {"params": {"lat": capsule['lat'], "lng": capsule['lng']},
+                                           "headers": headers[email]}))
+        return [summarize('open', *drive(backend.url, requests, ctx.concurrency))]
+
+
+def scenario_nearby(ctx):
+    """ Busca de cápsulas próximas em um usuário com 10 mil cápsulas georreferenciadas. """
+    email = "geo@bench.local"
+    rng = random.Random(5)
+    now = datetime.now()
+    seed(ctx.fake, [capsule_row(email, i, now, rng=rng) for i in range(ctx.count(10000))])
+
+    with ctx.backend() as backend:
+        headers = login(backend.url, [email])[email]
+        requests = [('GET', '/capsules/nearby', {"params": {"lat": ORIGIN[0] + rng.uniform(-0.04, 0.04),
+                                                            "lng": ORIGIN[1] + rng.uniform(-0.04, 0.04),
+                                                            "radius": 500},
+                                                 "headers": headers})
+                    for _ in range(ctx.count(1000))]
+        return [summarize('nearby', *drive(backend.url, requests, ctx.concurrency))]
+
+
+def run_expiry(ctx, n, window, lead=None, env=None, workers=None, name=None):
+    """
+    Expiração em massa: `n` cápsulas físicas com a mesma release_date, alguns
+    segundos após a subida do backend. Mede o atraso de cada publicação em relação
+    à release_date, a vazão de publicação e se alguma cápsula foi publicada mais de uma vez.
+    """
+    lead = ctx.expiry_lead if lead is None else lead
+    release = (datetime.now() + timedelta(seconds=lead)).replace(microsecond=0)
+    rows = [capsule_row(f"iot{i % 100}@bench.local", i, release, tipo='fisica')[0] for i in range(n)]
+    ctx.fake.insert('capsules', rows)
+    ctx.broker.clear()
+
+    with ctx.backend(env={"RELEASE_PUBLISH_WINDOW": str(window), **(env or {})}, workers=workers):
+        started_late = datetime.now() > release
+        deadline = time.monotonic() + lead + ctx.expiry_timeout
+        while time.monotonic() < deadline:
+            if len(set(published_ids(ctx.broker))) >= n:
+                break
+            time.sleep(0.2)
+        time.sleep(1.0)  # Janela para publicações duplicadas tardias
+        received = ctx.broker.received()
+
+    release_ts = release.timestamp()
+    ids = published_ids(ctx.broker)
+    lags = [max(0.0, ts - release_ts) for ts, _, _ in received]
+    elapsed = (max(ts for ts, _, _ in received) - release_ts) if received else 0.0
+    seeded = {row['id'] for row in rows}
+    notified = sum(1 for row in ctx.fake.rows('capsules', notificacao_enviada='true') if row['id'] in seeded)
+    result = summarize(name or f'expiry_w{window}', lags, n - len(set(ids)), elapsed, unit='messages',
+                       capsules=n, publish_window=window, duplicates=len(ids) - len(set(ids)),
+                       marked_notified=notified, started_late=started_late)
+    result["throughput"] = round(len(set(ids)) / elapsed, 1) if elapsed > 0 else 0.0
+    return result
+
+
+def published_ids(broker):
+    """ IDs das cápsulas publicadas no broker, na ordem de chegada (com repetições). """
+    ids = []
+    for payload in broker.payloads():
+        if isinstance(payload, dict) and isinstance(payload.get('capsula'), dict):
+            ids.append(payload['capsula'].get('id'))
+    return ids
+
+
+def scenario_expiry(ctx):
+    """ Expiração em massa de cápsulas físicas, variando o tamanho da janela de publicação. """
+    return [run_expiry(ctx, ctx.count(5000), window) for window in ctx.expiry_windows]
+
+
+def scenario_expiry_scaling(ctx):
+    """
+    Expiração em massa com vários processos de liberação (scheduler_worker.py no
+    modo claim) disputando as mesmas cápsulas: cada uma deve ser publicada uma
+    única vez e a vazão deve crescer com o número de processos.
+    """
+    n = ctx.count(5000)
+    env = {"RELEASE_PUBLISH_WINDOW": "50", "RELEASE_CLAIM_BATCH": "100"}
+    results = []
+    for workers in ctx.scaling_workers:
+        ctx.reset(mqtt_ack_ms=ctx.args.scaling_ack_ms)
+        release = (datetime.now() + timedelta(seconds=ctx.expiry_lead)).replace(microsecond=0)
+        rows = [capsule_row(f"iot{i % 100}@bench.local", i, release, tipo='fisica')[0] for i in range(n)]
+        ctx.fake.insert('capsules', rows)
+
+        processes = [Backend('scheduler', 1, {**ctx.backend_env(), **env}, ctx.log_dir) for _ in range(workers)]
+        try:
+            for process in processes:
+                process.start()
+            started_late = datetime.now() > release
+            deadline = time.monotonic() + ctx.expiry_lead + ctx.expiry_timeout
+            while time.monotonic() < deadline and len(set(published_ids(ctx.broker))) < n:
+                time.sleep(0.2)
+            time.sleep(1.0)  # Janela para publicações duplicadas tardias
+        finally:
+            for process in processes:
+                process.stop()
+
+        received = ctx.broker.received()
+        ids = published_ids(ctx.broker)
+        release_ts = release.timestamp()
+        elapsed = (max(ts for ts, _, _ in received) - release_ts) if received else 0.0
+        result = summarize(f'expiry_scaling_x{workers}', [max(0.0, ts - release_ts) for ts, _, _ in received],
+                           n - len(set(ids)), elapsed, unit='messages', capsules=n, workers=workers,
+                           duplicates=len(ids) - len(set(ids)), started_late=started_late)
+        result["throughput"] = round(len(set(ids)) / elapsed, 1) if elapsed > 0 else 0.0
+        result["server"] = 'scheduler'
+        if results:
+            result["speedup"] = round(result["throughput"] / results[0]["throughput"], 2)
+        results.append(result)
+    return results
+
+
+async def _run_events(backend, tokens, release, expected, concurrency, timeout):
+    """
+    Abre uma conexão SSE por usuário, mede a memória do backend, espera os
+    desbloqueios e notificações e, por fim, testa a retomada por Last-Event-ID
+    de 10% das conexões, fechadas antes da liberação.
+    """
+    gate = asyncio.Semaphore(concurrency)
+    http = httpx.AsyncClient(base_url=backend.url, timeout=30,
+                             limits=httpx.Limits(max_connections=concurrency))
+
+    async def open_client(user_id, last_event_id=None, client=None):
+        client = client or SseClient(backend.url, tokens[user_id], http)
+        async with gate:
+            try:
+                await client.connect(last_event_id)
+                await asyncio.wait_for(client.ready.wait(), 30)
+            except (OSError, httpx.HTTPError, asyncio.TimeoutError):
+                return None
+        return client
+
+    warm = [c for c in await asyncio.gather(*(open_client(u) for u in list(tokens)[:5])) if c]
+    for client in warm:
+        await client.close()
+    await asyncio.sleep(1.0)
+    rss_before = backend.rss_bytes()
+
+    start = time.perf_counter()
+    clients = dict(zip(tokens, await asyncio.gather(*(open_client(u) for u in tokens))))
+    connect_elapsed = time.perf_counter() - start
+    started_late = time.time() > release.timestamp()
+    connected = {u: c for u, c in clients.items() if c is not None}
+    await asyncio.sleep(1.0)
+    rss_after = backend.rss_bytes()
+
+    # Conexões que caem antes da liberação e voltam depois com o último ID recebido
+    resumed = {u: c for i, (u, c) in enumerate(connected.items()) if i % 10 == 5}
+    for client in resumed.values():
+        await client.close()
+    live = {u: c for u, c in connected.items() if u not in resumed}
+
+    def pending(users):
+        return [u for u in users
+                if {d['capsule_id'] for _, d in clients[u].received('unlocked')} < expected[u]['unlocked']
+                or {d['capsule_id'] for _, d in clients[u].received('notified')} < expected[u]['notified']]
+
+    deadline = time.monotonic() + max(0.0, release.timestamp() - time.time()) + timeout
+    while time.monotonic() < deadline and pending(live):
+        await asyncio.sleep(0.2)
+    await asyncio.sleep(0.5)
+
+    for user_id, client in resumed.items():
+        client.events.clear()
+    await asyncio.gather(*(open_client(u, c.resume_id, c) for u, c in resumed.items()))
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and pending(resumed):
+        await asyncio.sleep(0.2)
+
+    missing = len(pending(connected)) + len(clients) - len(connected)
+    for client in connected.values():
+        await client.close()
+    await http.aclose()
+    return connected, live, resumed, missing, connect_elapsed, started_late, rss_before, rss_after
+
+
+def scenario_events(ctx):
+    """
+    Notificações por SSE: milhares de conexões simultâneas (uma por usuário),
+    memória por assinante, atraso entre a release_date e a chegada do
+    `unlocked`, entrega do `notified` das cápsulas físicas e retomada.
+    """
+    n = ctx.count(2000)
+    release = (datetime.now() + timedelta(seconds=ctx.args.events_lead)).replace(microsecond=0)
+    user_ids = [user_id_for(f"sse{i}@bench.local") for i in range(n)]
+    tokens = mint_tokens(user_ids, ctx.backend_env()['JWT_SECRET_KEY'])
+
+    rows, expected = [], {}
+    for i, user_id in enumerate(user_ids):
+        capsules = [capsule_row(f"sse{i}@bench.local", i, release)[0]]
+        if i % 10 == 0:
+            capsules.append(capsule_row(f"sse{i}@bench.local", i, release, tipo='fisica')[0])
+        rows.extend(capsules)
+        expected[user_id] = {"unlocked": {c['id'] for c in capsules},
+                             "notified": {c['id'] for c in capsules if c['tipo'] == 'fisica'}}
+    ctx.fake.insert('capsules', rows)
+
+    with ctx.backend() as backend:
+        connected, live, resumed, missing, connect_elapsed, started_late, rss_before, rss_after = asyncio.run(
+            _run_events(backend, tokens, release, expected, ctx.concurrency * 4, ctx.expiry_timeout))
+
+    release_ts = release.timestamp()
+    lags = [max(0.0, ts - release_ts) for c in live.values() for ts, _ in c.received('unlocked')]
+    notified = sum(len(c.received('notified')) for c in connected.values())
+    elapsed = (max(ts for c in live.values() for ts, _ in c.received('unlocked')) - release_ts) if lags else 0.0
+    result = summarize('events', lags, missing, elapsed, unit='events', connections=len(connected),
+                       connect_s=round(connect_elapsed, 2),
+                       rss_per_subscriber_kb=round((rss_after - rss_before) / max(1, len(connected)) / 1024, 1),
+                       notified=notified, resumed=len(resumed),
+                       started_late=started_late)
+    return [result]
+
+
+def cached(scenario):
+    """
+    Variante com o cache local (CACHE_URL=memory), que não é o padrão e só é
+    correto com um worker: roda com um worker e marca os resultados com `_cached`.
+    """
+    def run(ctx):
+        return [{**result, "scenario": f"{result['scenario']}_cached"}
+                for result in scenario(ctx, env={"CACHE_URL": "memory"}, workers=1)]
+    return run
+
+
+SCENARIO_FUNCS = {
+    'login': scenario_login,
+    'create': scenario_create,
+    'bulk': scenario_bulk,
+    'list_10k': scenario_list_10k,
+    'list_10k_cached': cached(scenario_list_10k),
+    'open': scenario_open,
+    'open_cached': cached(scenario_open),
+    'nearby': scenario_nearby,
+    'expiry': scenario_expiry,
+    'expiry_scaling': scenario_expiry_scaling,
+    'events': scenario_events,
+}
+
+
+# --- Orquestração ---
+
+class Context:
+    """ Estado compartilhado por um cenário: Supabase falso, broker e fábrica do backend. """
+
+    def __init__(self, args, server, log_dir):
+        self.args = args
+        self.server = server
+        self.log_dir = log_dir
+        self.concurrency = args.concurrency
+        self.expiry_windows = [int(w) for w in args.expiry_windows.split(',')]
+        self.expiry_lead = args.expiry_lead
+        self.expiry_timeout = args.expiry_timeout
+        self.scaling_workers = [int(w) for w in args.scaling_workers.split(',')]
+        self.fake = None
+        self.broker = None
+
+    def count(self, n):
+        return max(1, int(n * self.args.scale))
+
+    def reset(self, mqtt_ack_ms=None):
+        """ Supabase e broker novos para cada cenário, para que um não influencie o outro. """
+        self.close()
+        self.fake = FakeSupabaseProcess(latency=self.args.latency_ms / 1000, jitter=self.args.jitter).start()
+        ack_ms = self.args.mqtt_ack_ms if mqtt_ack_ms is None else mqtt_ack_ms
+        self.broker = MqttBroker(ack_delay=ack_ms / 1000).start()
+
+    def close(self):
+        if self.fake:
+            self.fake.stop()
+        if self.broker:
+            self.broker.stop()
+
+    def backend_env(self):
+        return {
+            "SUPABASE_URL": self.fake.url,
+            "SUPABASE_KEY": "bench",
+            "JWT_SECRET_KEY": "bench-secret-bench-secret-bench-secret",
+            "MQTT_BROKER_URL": self.broker.host,
+            "MQTT_PORT": str(self.broker.port),
+            "MQTT_TLS": "0",
+            "MQTT_USER": "",
+            "MQTT_PASSWORD": "",
+            "LOG_LEVEL": "WARNING",
+            "CACHE_URL": "",  # Padrão de produção; as variantes `_cached` ligam o cache local
+            "EVENTS_WSGI": "1",  # Werkzeug com threads / gunicorn gthread suportam streams longos
+        }
+
+    def backend(self, env=None, workers=None):
+        ctx = self
+
+        class _Running:
+            def __enter__(self):
+                n = workers or ctx.args.workers
+                # O agendador embutido só aceita um worker; com mais, cada um reivindica no banco
+                scheduler = {} if n == 1 else {"SCHEDULER_MODE": "claim"}
+                self.backend = Backend(ctx.server, n, {**ctx.backend_env(), **scheduler, **(env or {})},
+                                       ctx.log_dir).start()
+                return self.backend
+
+            def __exit__(self, *exc):
+                self.backend.stop()
+                return False
+        return _Running()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Compara com a linha de base. Regressão: vazão abaixo de (1 - threshold) ou
+    p95 acima de (1 + threshold) do valor de referência. Erros (requisições
+    falhas, cápsulas não publicadas, eventos SSE perdidos) e duplicatas são
+    regressão mesmo sem linha de base: um resultado rápido pode estar errado.
+    """
+    reference = {f"{r['server']}/{r['scenario']}": r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        key = f"{result['server']}/{result['scenario']}"
+        reasons = []
+        if result.get('errors'):
+            reasons.append(f"{result['errors']} erros")
+        if result.get('duplicates'):
+            reasons.append(f"{result['duplicates']} publicações duplicadas")
+        if result.get('started_late'):
+            reasons.append("a carga começou depois da release_date (medição inválida)")
+        base = reference.get(key)
+        if base is not None:
+            result['baseline'] = {"throughput": base['throughput'], "p95_ms": base['p95_ms']}
+            if base['throughput'] and result['throughput'] < base['throughput'] * (1 - threshold):
+                reasons.append(f"vazão {result['throughput']} < {base['throughput']}")
+            if base['p95_ms'] and result['p95_ms'] > base['p95_ms'] * (1 + threshold):
+                reasons.append(f"p95 {result['p95_ms']}ms > {base['p95_ms']}ms")
+        if reasons:
+            result['regression'] = reasons
+            regressions.append((key, reasons))
+    return regressions
+
+
+def print_table(results):
+    header = f"{'cenário':<28}{'vazão':>14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'erros':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        flag = '  <-- REGRESSÃO' if r.get('regression') else ''
+        print(f"{r['server'] + '/' + r['scenario']:<28}{r['throughput']:>10} {r['throughput_unit'].split('/')[0][:3]}/s"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['errors']:>8}{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks do backend com Supabase e MQTT locais")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Lista separada por vírgulas: {', '.join(SCENARIO_FUNCS)}")
+    parser.add_argument('--server', default='wsgi', help="wsgi, asgi ou wsgi,asgi para comparar")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplicador do volume de cada cenário")
+    parser.add_argument('--latency-ms', type=float, default=5.0, help="Latência simulada por chamada ao Supabase")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Variação relativa da latência simulada")
+    parser.add_argument('--mqtt-ack-ms', type=float, default=2.0, help="Atraso simulado do PUBACK")
+    parser.add_argument('--expiry-windows', default='50,200,1000', help="Valores de RELEASE_PUBLISH_WINDOW")
+    parser.add_argument('--expiry-lead', type=float, default=8.0,
+                        help="Segundos entre a subida do backend e a release_date das cápsulas")
+    parser.add_argument('--expiry-timeout', type=float, default=120.0)
+    parser.add_argument('--events-lead', type=float, default=60.0,
+                        help="Segundos entre a subida do backend e a liberação no cenário events")
+    parser.add_argument('--scaling-workers', default='1,2,4',
+                        help="Quantidades de processos de liberação no cenário expiry_scaling")
+    parser.add_argument('--scaling-ack-ms', type=float, default=25.0,
+                        help="Atraso do PUBACK no expiry_scaling (broker remoto típico)")
+    parser.add_argument('--output', help="Arquivo JSON para salvar os resultados")
+    parser.add_argument('--baseline', help="Resultados de referência para detectar regressões")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Tolerância relativa antes de acusar regressão")
+    parser.add_argument('--log-dir', help="Mantém aqui os logs do backend (por padrão vão para um diretório temporário)")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    names = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in names if s not in SCENARIO_FUNCS]
+    if unknown:
+        parser.error(f"Cenários desconhecidos: {', '.join(unknown)}")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='tc-bench-') as temp_dir:
+        log_dir = args.log_dir or temp_dir
+        os.makedirs(log_dir, exist_ok=True)
+        for index, server in enumerate([s.strip() for s in args.server.split(',')]):
+            ctx = Context(args, server, log_dir)
+            try:
+                for name in names:
+                    if index and name in SERVERLESS_SCENARIOS:
+                        continue
+                    ctx.reset()
+                    print(f"[{server}] {name}...", file=sys.stderr, flush=True)
+                    for result in SCENARIO_FUNCS[name](ctx):
+                        results.append({"server": server, **result})
+            finally:
+                ctx.close()
+
+    config = {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'log_dir')}
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differing = [k for k, v in config.items()
+                     if k not in ('scenarios', 'server') and baseline.get('config', {}).get(k, v) != v]
+        if differing:
+            print(f"Aviso: configuração diferente da linha de base ({', '.join(differing)}); "
+                  "a comparação pode não ser justa.", file=sys.stderr)
+
+    regressions = compare(results, baseline, args.threshold)
+    print_table(results)
+    report = {
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": config,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"\nResultados salvos em {args.output}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regressão(ões)" + (f" em relação a {args.baseline}:" if args.baseline else ":"))
+        for key, reasons in regressions:
+            print(f"  {key}: {'; '.join(reasons)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+# Camada de cache do backend: LRU+TTL em memória ou Redis compartilhado
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Cache LRU com expiração por entrada, seguro para uso entre threads.
+    Ao atingir `maxsize`, a entrada usada há mais tempo é descartada.
+    """
+
+    blocking = False  # Só memória: pode ser chamado direto do event loop
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # chave -> (expira_em, valor)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        """ Retorna um dict só com as chaves encontradas (e não expiradas). """
+        found = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def incr(self, key):
+        """ Incrementa um contador inteiro (usado nas versões de invalidação). """
+        with self._lock:
+            entry = self._data.get(key)
+            value = (entry[1] if entry and entry[0] > time.monotonic() else 0) + 1
+            # Contadores de versão não expiram; o LRU ainda pode descartá-los
+            self._data[key] = (float('inf'), value)
+            self._data.move_to_end(key)
+            return value
+
+
+class RedisCache:
+    """
+    Backend compartilhado entre workers/instâncias (ex.: vários workers do
+    gunicorn). Os valores são serializados em JSON.
+    """
+
+    blocking = True  # Ida ao Redis: no modo assíncrono roda em uma thread
+
+    def __init__(self, url, ttl=300, prefix='tc:'):
+        import redis  # Dependência opcional: só é necessária com CACHE_URL=redis://...
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key, default=None):
+        raw = self._redis.get(self.prefix + key)
+        return default if raw is None else json.loads(raw)
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        raws = self._redis.mget([self.prefix + key for key in keys])
+        return {key: json.loads(raw) for key, raw in zip(keys, raws) if raw is not None}
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl if ttl is None else ttl)))
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def incr(self, key):
+        return self._redis.incr(self.prefix + key)
+
+
+def create_cache_backend(url=None, ttl=300, maxsize=10000):
+    """
+    "redis://..." usa Redis; "memory" usa o cache local, só para um único
+    processo; vazio desativa o cache (None). Com vários workers, um cache local
+    serviria dados antigos: cada worker só vê as próprias invalidações.
+    """
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url, ttl=ttl)
+    if url == 'memory':
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    return None
+
+
+class _InFlight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ReadThroughCache:
+    """
+    Cache de leitura sobre um backend (TTLCache ou RedisCache).
+
+    - As chaves são agrupadas por usuário com um número de versão; invalidar um
+      usuário apenas incrementa a versão, o que aposenta todas as suas entradas.
+    - Falhas simultâneas na mesma chave (no mesmo processo) são coalescidas:
+      só uma thread (ou corrotina) chama o `loader`, as demais esperam o resultado.
+    - Mantém contadores de acertos/falhas para dimensionar o cache.
+    - Sem backend (None), nada é guardado: toda leitura chama o `loader`.
+    - Um erro do backend (ex.: Redis fora do ar) conta em `errors` e vira falha
+      de cache: a leitura segue pelo `loader` em vez de propagar o erro.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._atasks = {}  # Cargas em andamento no modo assíncrono (um event loop por processo)
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _backend_failed(self, operation, error):
+        self._count("errors")
+        logger.warning("Falha no backend de cache; seguindo sem cache",
+                       extra={"operation": operation, "error": str(error)})
+
+    def _call(self, operation, method, *args, default=_MISSING):
+        """ Chamada ao backend que devolve `default` (e conta o erro) se ele falhar. """
+        try:
+            return method(*args)
+        except Exception as e:
+            self._backend_failed(operation, e)
+            return default
+
+    async def _acall(self, operation, method, *args, default=_MISSING):
+        """ Versão assíncrona de `_call`; backends de rede rodam em uma thread. """
+        try:
+            if self.backend.blocking:
+                return await asyncio.to_thread(method, *args)
+            return method(*args)
+        except Exception as e:
+            self._backend_failed(operation, e)
+            return default
+
+    @staticmethod
+    def _format_key(user_id, version, parts):
+        if version is _MISSING:
+            return None  # Sem a versão não há como respeitar invalidações: leitura sem cache
+        return ":".join([f"u:{user_id}", f"v{version}", *map(str, parts)])
+
+    def user_key(self, user_id, *parts):
+        """ Chave versionada do usuário, ou None se o backend falhar. """
+        version = self._call("get", self.backend.get, f"uv:{user_id}", 0) if self.backend is not None else 0
+        return self._format_key(user_id, version, parts)
+
+    async def auser_key(self, user_id, *parts):
+        """ Versão assíncrona de `user_key`. """
+        version = await self._acall("get", self.backend.get, f"uv:{user_id}", 0) if self.backend is not None else 0
+        return self._format_key(user_id, version, parts)
+
+    def invalidate_user(self, user_id):
+        if self.backend is None:
+            return
+        if self._call("incr", self.backend.incr, f"uv:{user_id}") is not _MISSING:
+            self._count("invalidations")
+
+    async def ainvalidate_user(self, user_id):
+        """ Versão assíncrona de `invalidate_user`. """
+        if self.backend is None:
+            return
+        if await self._acall("incr", self.backend.incr, f"uv:{user_id}") is not _MISSING:
+            self._count("invalidations")
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Retorna o valor em cache ou o carrega com `loader()`. `None` não é
+        guardado; com `key` None (ver `user_key`) a leitura ignora o cache.
+        """
+        if self.backend is None or key is None:
+            return loader()
+        value = self._call("get", self.backend.get, key, _MISSING)
+        if value is not _MISSING:
+            self._count("hits")
+            return value
+
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _InFlight()
+
+        if not leader:
+            call.event.wait()
+            self._count("coalesced")
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        self._count("misses")
+        try:
+            call.value = loader()
+            if call.value is not None:
+                self._call("set", self.backend.set, key, call.value, ttl)
+            return call.value
+        except Exception as e:
+            call.error = e
+            self._count("errors")
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+
+    async def aget_or_load(self, key, loader, ttl=None):
+        """ Versão assíncrona de `get_or_load`: `loader` é uma função async. """
+        if self.backend is None or key is None:
+            return await loader()
+        value = await self._acall("get", self.backend.get, key, _MISSING)
+        if value is not _MISSING:
+            self._count("hits")
+            return value
+
+        task = self._atasks.get(key)
+        if task is not None:
+            self._count("coalesced")
+            return await task
+
+        self._count("misses")
+        task = self._atasks[key] = asyncio.ensure_future(self._aload(key, loader, ttl))
+        return await task
+
+    async def _aload(self, key, loader, ttl):
+        try:
+            value = await loader()
+            if value is not None:
+                await self._acall("set", self.backend.set, key, value, ttl)
+            return value
+        except Exception:
+            self._count("errors")
+            raise
+        finally:
+            self._atasks.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["backend"] = type(self.backend).__name__ if self.backend is not None else None
+        return stats
@@ -0,0 +1,296 @@
+# Eventos das cápsulas em tempo real, entregues por Server-Sent Events (SSE)
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PING_FRAME = ": ping\n\n"
+RESET_FRAME = "event: reset\ndata: {}\n\n"
+
+
+def event_key(event_id):
+    """ Converte um ID "ms-seq" em (ms, seq) para comparação. None se inválido. """
+    try:
+        ms, _, seq = str(event_id).partition('-')
+        return int(ms), int(seq or 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def event_time(event_id):
+    """ Instante (hora local "naive") em que o evento foi emitido, pelo seu ID. """
+    key = event_key(event_id)
+    return datetime.fromtimestamp(key[0] / 1000) if key else None
+
+
+class Event:
+    """ Evento já serializado: o frame SSE é montado uma vez e enviado a todos os assinantes. """
+
+    __slots__ = ("id", "key", "user_id", "type", "frame")
+
+    def __init__(self, event_id, user_id, event_type, data):
+        self.id = event_id
+        self.key = event_key(event_id)
+        self.user_id = user_id
+        self.type = event_type
+        self.frame = f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Subscription:
+    """
+    Fila de uma conexão SSE. Funciona com uma thread (WSGI, `poll`) ou com uma
+    corrotina (ASGI, `apoll`, com o event loop em `loop`). Se o cliente não
+    acompanhar e a fila encher, os eventos pendentes são descartados e o
+    cliente recebe `reset` (deve recarregar o estado pela API).
+    """
+
+    __slots__ = ("user_id", "resume_id", "lagged", "_queue", "_maxsize", "_loop", "_waker")
+
+    def __init__(self, user_id, resume_id, maxsize=256, loop=None):
+        self.user_id = user_id
+        self.resume_id = resume_id
+        self.lagged = False
+        self._queue = deque()
+        self._maxsize = maxsize
+        self._loop = loop
+        self._waker = asyncio.Event() if loop is not None else threading.Event()
+
+    def push(self, event):
+        if len(self._queue) >= self._maxsize:
+            self._queue.clear()
+            self.lagged = True
+        else:
+            self._queue.append(event)
+        if self._loop is None:
+            self._waker.set()
+        elif not self._waker.is_set():
+            self._loop.call_soon_threadsafe(self._waker.set)
+
+    def reset(self):
+        """ Pede ao cliente que recarregue o estado (eventos perdidos). """
+        self._queue.clear()
+        self.lagged = True
+
+    def hello(self, retry_ms=5000):
+        """ Primeiro frame: intervalo de reconexão e o ID a partir do qual retomar. """
+        return f"retry: {retry_ms}\nid: {self.resume_id}\nevent: ready\ndata: {{}}\n\n"
+
+    def _drain(self):
+        frames = []
+        if self.lagged:
+            self.lagged = False
+            frames.append(RESET_FRAME)
+        while self._queue:
+            frames.append(self._queue.popleft().frame)
+        return ''.join(frames)
+
+    def poll(self, timeout):
+        """ Espera eventos por até `timeout` segundos. Retorna os frames, ou um heartbeat. """
+        self._waker.clear()
+        chunk = self._drain()
+        if not chunk and self._waker.wait(timeout):
+            chunk = self._drain()
+        return chunk or PING_FRAME
+
+    async def apoll(self, timeout):
+        """ Versão assíncrona de `poll`. """
+        self._waker.clear()
+        chunk = self._drain()
+        if not chunk:
+            try:
+                await asyncio.wait_for(self._waker.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            chunk = self._drain()
+        return chunk or PING_FRAME
+
+
+class EventBroker:
+    """
+    Distribui os eventos de cada usuário às conexões abertas neste processo.
+
+    - Os assinantes ficam indexados por usuário: publicar custa o número de
+      conexões daquele usuário, não o total de conexões.
+    - Os últimos `buffer_size` eventos ficam em um buffer circular; uma conexão
+      que volta com `Last-Event-ID` recebe o que perdeu. Se o ID for anterior ao
+      buffer (ou a este processo), recebe `reset`.
+    - IDs "ms-seq" crescentes, no mesmo formato dos IDs de stream do Redis.
+    """
+
+    def __init__(self, buffer_size=10000, queue_size=256):
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self.relay = None
+        self._lock = threading.Lock()
+        self._buffer = deque()
+        self._subscribers = {}  # user_id -> set(Subscription)
+        self._last_ms = 0
+        self._seq = 0
+        self._floor = event_key(self._next_id())  # Eventos anteriores não estão no buffer
+        self._stats = {"published": 0, "delivered": 0, "replayed": 0, "resets": 0}
+
+    def _next_id(self):
+        ms = int(time.time() * 1000)
+        if ms <= self._last_ms:
+            self._seq += 1
+        else:
+            self._last_ms, self._seq = ms, 0
+        return f"{self._last_ms}-{self._seq}"
+
+    def publish(self, user_id, event_type, data, local=False):
+        """
+        Emite um evento para um usuário. Com um relay (Redis), o evento passa por
+        ele e chega a todos os processos; `local=True` entrega só neste processo.
+        Falhas no relay são registradas e não interrompem quem publica.
+        """
+        if self.relay is not None and not local:
+            try:
+                self.relay.publish(user_id, event_type, data)
+            except Exception:
+                logger.exception("Erro ao publicar evento no relay", extra={"type": event_type})
+            return None
+        return self.deliver(None, user_id, event_type, data)
+
+    def deliver(self, event_id, user_id, event_type, data, dispatch=True):
+        """ Guarda o evento no buffer e o entrega às conexões do usuário. """
+        with self._lock:
+            event = Event(event_id or self._next_id(), user_id, event_type, data)
+            self._buffer.append(event)
+            if len(self._buffer) > self.buffer_size:
+                self._floor = self._buffer.popleft().key
+            self._stats["published"] += 1
+            if not dispatch:
+                return event
+            for subscription in self._subscribers.get(user_id, ()):
+                subscription.push(event)
+                self._stats["delivered"] += 1
+        return event
+
+    def subscribe(self, user_id, last_event_id=None, loop=None):
+        """
+        Registra uma conexão. Eventos perdidos desde `last_event_id` já entram
+        na fila; `resume_id` é o ID a enviar no frame inicial.
+        """
+        if self.relay is not None:
+            self.relay.start()
+        with self._lock:
+            key = event_key(last_event_id) if last_event_id else None
+            lost = bool(last_event_id) and (key is None or key < self._floor)
+            resume_id = last_event_id if key and not lost else self._next_id()
+            subscription = Subscription(user_id, resume_id, self.queue_size, loop)
+            if last_event_id:
+                if lost:
+                    subscription.reset()
+                    self._stats["resets"] += 1
+                else:
+                    for event in self._buffer:
+                        if event.user_id == user_id and event.key > key:
+                            subscription.push(event)
+                            self._stats["replayed"] += 1
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def set_floor(self, key):
+        """ IDs anteriores a `key` não podem mais ser retomados (usado pelo relay). """
+        with self._lock:
+            self._floor = key
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.user_id]
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def subscribed_users(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "subscribers": sum(len(s) for s in self._subscribers.values()),
+                "users": len(self._subscribers),
+                "buffered": len(self._buffer)
+            }
+
+
+class RedisEventRelay:
+    """
+    Relay entre processos por um stream do Redis: quem publica faz XADD e cada
+    processo com conexões abertas lê o stream e entrega localmente. Os IDs do
+    stream viram os IDs dos eventos, iguais em todos os processos.
+    """
+
+    STREAM = 'tc:events'
+
+    def __init__(self, broker, url):
+        import redis  # Dependência opcional: só é necessária com EVENTS_URL=redis://...
+        self.broker = broker
+        self._redis = redis.Redis.from_url(url)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def publish(self, user_id, event_type, data):
+        self._redis.xadd(self.STREAM, {"u": user_id, "t": event_type, "d": json.dumps(data)},
+                         maxlen=self.broker.buffer_size, approximate=True)
+
+    def _deliver(self, entry_id, fields, dispatch=True):
+        self.broker.deliver(entry_id.decode(), fields[b'u'].decode(), fields[b't'].decode(),
+                            json.loads(fields[b'd']), dispatch=dispatch)
+
+    def start(self):
+        """
+        Na primeira conexão do processo: passa a seguir o stream em uma thread.
+        Não bloqueia quem chama (pode ser o event loop do modo ASGI); até o
+        buffer ser carregado, uma retomada por `Last-Event-ID` recebe `reset`.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="events-relay", daemon=True)
+            self._thread.start()
+
+    def _preload(self):
+        """ Carrega no buffer os últimos eventos do stream. Retorna o ID a partir do qual seguir. """
+        entries = self._redis.xrevrange(self.STREAM, count=self.broker.buffer_size)
+        for entry_id, fields in reversed(entries):
+            self._deliver(entry_id, fields, dispatch=False)
+        # Stream mais curto que o buffer: nada foi descartado, qualquer ID pode ser retomado
+        self.broker.set_floor(event_key(entries[-1][0].decode())
+                              if len(entries) >= self.broker.buffer_size else (0, 0))
+        return entries[0][0].decode() if entries else '0-0'
+
+    def _run(self):
+        try:
+            last_id = self._preload()
+        except Exception:
+            logger.exception("Erro ao carregar eventos do Redis")
+            last_id = '$'  # Sem o histórico, segue só os novos
+        while True:
+            try:
+                for _, entries in self._redis.xread({self.STREAM: last_id}, block=5000, count=1000) or ():
+                    for entry_id, fields in entries:
+                        self._deliver(entry_id, fields)
+                        last_id = entry_id
+            except Exception:
+                logger.exception("Erro ao ler eventos do Redis")
+                time.sleep(1)
+
+
+def create_event_broker(url=None, buffer_size=10000, queue_size=256):
+    """ `EVENTS_URL` vazio entrega só neste processo; "redis://..." usa o relay do Redis. """
+    broker = EventBroker(buffer_size=buffer_size, queue_size=queue_size)
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        broker.relay = RedisEventRelay(broker, url)
+    return broker
@@ -0,0 +1,480 @@
+# Instrumentação do backend: métricas no formato Prometheus e logs estruturados em JSON
+import bisect
+import inspect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """ Estado de todas as métricas como dados serializáveis (ver MultiProcessCollector). """
+        with self._lock:
+            metrics = list(self._metrics)
+        return [metric.snapshot() for metric in metrics]
+
+    def render(self):
+        """ Exposição em texto no formato do Prometheus (versão 0.0.4). """
+        return render_families(self.snapshot())
+
+
+def _render_family(family):
+    lines = [f"# HELP {family['name']} {family['help']}", f"# TYPE {family['name']} {family['type']}"]
+    name, labelnames = family['name'], family['labelnames']
+    if family['type'] != "histogram":
+        lines.extend(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}"
+                     for labels, value in family['values'])
+        return lines
+    bounds = [float(b) for b in family['buckets']] + [math.inf]
+    for labels, (counts, total, count) in family['values']:
+        cumulative = 0
+        for bound, bucket_count in zip(bounds, counts):
+            cumulative += bucket_count
+            le = (("le", _format_value(bound)),)
+            lines.append(f"{name}_bucket{_format_labels(labelnames, labels, le)} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, labels)} {count}")
+    return lines
+
+
+def render_families(families):
+    lines = []
+    for family in families:
+        lines.extend(_render_family(family))
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _family(self, values):
+        return {"name": self.name, "help": self.help, "type": self.type,
+                "labelnames": list(self.labelnames), "values": values}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return self._family([[list(k), v] for k, v in self._values.items()])
+
+
+class Gauge(_Metric):
+    """ Valor instantâneo. Com `fn`, é lido na hora da coleta (fn retorna número ou {labels: valor}). """
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), fn=None, registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def snapshot(self):
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                value = {}
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self._family([[list(k), v] for k, v in items])
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Contagens por bucket (+Inf no fim), soma e total
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(k), [list(v[0]), v[1], v[2]]] for k, v in self._values.items()]
+        return {**self._family(values), "buckets": list(self.buckets)}
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+# --- Vários processos ---
+
+class MultiProcessCollector:
+    """
+    Agrega as métricas dos processos de um mesmo serviço (ex.: gunicorn -w 4),
+    já que cada um tem o próprio REGISTRY. Cada processo grava um retrato das
+    suas métricas em `path` a cada `interval` segundos (e a cada coleta), e o
+    /metrics de qualquer worker combina todos os arquivos:
+
+    - contadores e histogramas são somados, inclusive os de processos que já
+      terminaram, então os totais nunca voltam;
+    - gauges ganham o rótulo `pid` e só entram os de processos vivos.
+
+    O diretório deve ser esvaziado antes de subir o serviço e não deve ser
+    compartilhado com outro serviço (como no prometheus_client).
+    """
+
+    def __init__(self, registry, path, interval=5.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._file = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def start(self):
+        """ Inicia a gravação periódica; repete após um fork (gunicorn --preload). """
+        self._start_thread()
+        os.register_at_fork(after_in_child=self._start_thread)
+
+    def _start_thread(self):
+        # Um arquivo por processo; o instante evita reaproveitar o de um pid reciclado
+        self._file = os.path.join(self.path, f"{os.getpid()}-{time.time_ns()}.json")
+        threading.Thread(target=self._run, name="metrics-writer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.write()
+            except Exception:
+                logging.getLogger(__name__).exception("Erro ao gravar métricas do processo")
+            time.sleep(self.interval)
+
+    def write(self):
+        with self._lock:
+            if self._file is None:
+                return
+            data = json.dumps({"pid": os.getpid(), "families": self.registry.snapshot()})
+            tmp = f"{self._file}.tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self._file)
+
+    def collect(self):
+        """ Famílias de métricas combinadas de todos os processos. """
+        self.write()
+        merged = {}
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # Arquivo removido ou sendo substituído
+            alive = _pid_alive(data["pid"])
+            for family in data["families"]:
+                if family["type"] == "gauge" and not alive:
+                    continue
+                target = merged.setdefault(family["name"], {**family, "values": {}})
+                if family["type"] == "gauge":
+                    target["labelnames"] = family["labelnames"] + ["pid"]
+                for labels, value in family["values"]:
+                    if family["type"] == "gauge":
+                        target["values"][tuple(labels) + (data["pid"],)] = value
+                    elif family["type"] == "histogram":
+                        current = target["values"].get(tuple(labels))
+                        if current is None:
+                            target["values"][tuple(labels)] = [list(value[0]), value[1], value[2]]
+                        else:
+                            current[0] = [a + b for a, b in zip(current[0], value[0])]
+                            current[1] += value[1]
+                            current[2] += value[2]
+                    else:
+                        key = tuple(labels)
+                        target["values"][key] = target["values"].get(key, 0) + value
+        for family in merged.values():
+            family["values"] = [[list(k), v] for k, v in family["values"].items()]
+        return list(merged.values())
+
+    def render(self):
+        return render_families(self.collect())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# --- Supabase instrumentado ---
+
+SUPABASE_LATENCY = Histogram(
+    "supabase_request_duration_seconds",
+    "Duração das chamadas ao Supabase (PostgREST, Storage, Auth)",
+    ("service", "target", "operation")
+)
+SUPABASE_ERRORS = Counter(
+    "supabase_request_errors_total",
+    "Chamadas ao Supabase que lançaram exceção",
+    ("service", "target", "operation")
+)
+
+_QUERY_OPERATIONS = {"select", "insert", "update", "upsert", "delete"}
+
+
+def _observe(labels, start, failed):
+    SUPABASE_LATENCY.observe(time.perf_counter() - start, *labels)
+    if failed:
+        SUPABASE_ERRORS.inc(*labels)
+
+
+def _timed_call(method, labels):
+    """ Cronometra uma chamada síncrona ou assíncrona (corrotina). """
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            _observe(labels, start, True)
+            raise
+        if not inspect.isawaitable(result):
+            _observe(labels, start, False)
+            return result
+
+        async def wait():
+            try:
+                value = await result
+            except Exception:
+                _observe(labels, start, True)
+                raise
+            _observe(labels, start, False)
+            return value
+        return wait()
+    return call
+
+
+class _TimedQuery:
+    """ Envolve um builder do PostgREST; só `execute()` é cronometrado, rotulado pela tabela e operação. """
+
+    __slots__ = ("_target", "_table", "_operation")
+
+    def __init__(self, target, table, operation):
+        self._target = target
+        self._table = table
+        self._operation = operation
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name == "execute":
+            return _timed_call(attr, ("postgrest", self._table, self._operation))
+        operation = name if name in _QUERY_OPERATIONS else self._operation
+        if not callable(attr):
+            # Propriedades como `not_` devolvem outro builder
+            return _TimedQuery(attr, self._table, operation) if hasattr(attr, "execute") else attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if hasattr(result, "execute"):
+                return _TimedQuery(result, self._table, operation)
+            return result
+        return call
+
+
+class _TimedCalls:
+    """ Cronometra todas as chamadas de método de um objeto (buckets do Storage, Auth). """
+
+    __slots__ = ("_target", "_service", "_name")
+
+    def __init__(self, target, service, name):
+        self._target = target
+        self._service = service
+        self._name = name
+
+    def __getattr__(self, attr_name):
+        attr = getattr(self._target, attr_name)
+        if not callable(attr) or attr_name.startswith("_"):
+            return attr
+        return _timed_call(attr, (self._service, self._name, attr_name))
+
+
+class _TimedStorage:
+    __slots__ = ("_target",)
+
+    def __init__(self, target):
+        self._target = target
+
+    def from_(self, bucket):
+        return _TimedCalls(self._target.from_(bucket), "storage", bucket)
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+
+class InstrumentedSupabase:
+    """
+    Proxy do cliente Supabase (síncrono ou assíncrono) que registra a duração
+    e as falhas de cada chamada por serviço, tabela/bucket e operação.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.storage = _TimedStorage(client.storage)
+        self.auth = _TimedCalls(client.auth, "auth", "auth")
+
+    def table(self, name):
+        return _TimedQuery(self._client.table(name), name, "select")
+
+    from_ = table
+
+    def rpc(self, fn, params=None, *args, **kwargs):
+        return _TimedQuery(self._client.rpc(fn, params or {}, *args, **kwargs), f"rpc:{fn}", "rpc")
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+# --- Logs estruturados ---
+
+class JsonFormatter(logging.Formatter):
+    """ Uma linha JSON por evento; campos passados em `extra=` entram no objeto. """
+
+    _RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self._RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level="INFO"):
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # O httpx registra cada requisição em INFO; as durações já estão nas métricas
+    logging.getLogger("httpx").setLevel(max(logging.WARNING, root.level))
+
+
+if __name__ == '__main__':
+    # Custo da instrumentação por requisição, sem rede: `python metrics.py`
+    import argparse
+
+    class _FakeQuery:
+        def select(self, *args):
+            return self
+
+        def eq(self, *args):
+            return self
+
+        def execute(self):
+            return None
+
+    class _FakeClient:
+        storage = auth = None
+
+        def table(self, name):
+            return _FakeQuery()
+
+    parser = argparse.ArgumentParser(description="Mede o custo da instrumentação (µs por operação)")
+    parser.add_argument("--count", type=int, default=200000)
+    args = parser.parse_args()
+    registry = Registry()
+    http = Histogram("bench_http_seconds", "bench", ("method", "route", "status"), registry=registry)
+    SUPABASE_LATENCY.observe(0.01, "postgrest", "capsules", "select")  # série já existente, como em produção
+    raw, timed = _FakeClient(), InstrumentedSupabase(_FakeClient())
+
+    def measure(fn):
+        start = time.perf_counter()
+        for _ in range(args.count):
+            fn()
+        return (time.perf_counter() - start) / args.count * 1e6
+
+    observe = measure(lambda: http.observe(0.012, "GET", "/capsules", 200))
+    query_raw = measure(lambda: raw.table('capsules').select('*').eq('id', 1).execute())
+    query_timed = measure(lambda: timed.table('capsules').select('*').eq('id', 1).execute())
+    print(f"Histogram.observe:                {observe:.2f} µs")
+    print(f"consulta PostgREST (proxy):       {query_timed - query_raw:.2f} µs a mais por consulta")
+    print(f"requisição típica (1 observe + 2 consultas): {observe + 2 * (query_timed - query_raw):.2f} µs")
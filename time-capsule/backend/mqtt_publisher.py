@@ -0,0 +1,255 @@
+# Publicador MQTT persistente com fila de saída (outbox)
+import json
+import queue
+import ssl
+import threading
+import logging
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+
+class MqttPublisher:
+    """
+    Mantém UMA sessão MQTT (TLS opcional) aberta durante toda a vida do processo.
+
+    As mensagens entram numa fila em memória (outbox) e são drenadas por uma
+    thread em segundo plano, que publica com QoS 1 sem esperar o PUBACK de cada
+    uma (pipelining). Cada publicação devolve um Future resolvido quando o
+    broker confirma o recebimento, ou com erro se `ack_timeout` segundos se
+    passarem desde o enfileiramento. Mensagens que expiram (ou cujo Future foi
+    cancelado) ainda na fila são descartadas sem publicar, para que uma cópia
+    abandonada pelo chamador não seja entregue quando o broker voltar.
+    Mensagens já aceitas pelo Paho são reenviadas por ele após uma reconexão.
+    """
+
+    def __init__(self, host, port, username=None, password=None, topic=None,
+                 tls=True, keepalive=60, max_inflight=100, outbox_size=10000,
+                 ack_timeout=30.0, client_id=""):
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.keepalive = keepalive
+        self.ack_timeout = ack_timeout
+
+        self._outbox = queue.Queue(maxsize=outbox_size)
+        self._pending = {}  # mid -> (Future, prazo)
+        self._early_acks = {}  # mid -> reason_code de PUBACKs que chegaram antes do registro
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._outstanding = 0
+        self._connected = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats = {"enviadas": 0, "confirmadas": 0, "falhas": 0, "reconexoes": 0}
+
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                                   client_id=client_id, transport="tcp")
+        if username:
+            self._client.username_pw_set(username, password)
+        if tls:
+            self._client.tls_set(tls_version=ssl.PROTOCOL_TLSv1_2)
+            self._client.tls_insecure_set(False)
+        self._client.max_inflight_messages_set(max_inflight)
+        self._client.max_queued_messages_set(0)  # Sem limite: o outbox já é limitado
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+
+    # --- Ciclo de vida ---
+
+    def start(self):
+        """ Abre a conexão (assíncrona, com reconexão automática) e inicia a drenagem. """
+        if self._thread is not None:
+            return
+        logger.info("Conectando ao broker MQTT (persistente)", extra={"host": self.host, "port": self.port})
+        self._client.connect_async(self.host, self.port, self.keepalive)
+        self._client.loop_start()
+        self._thread = threading.Thread(target=self._drain_loop, name="mqtt-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """ Drena o que estiver pendente (até `timeout`) e encerra a sessão. """
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._stopping.set()
+        self._thread.join(timeout=1.0)
+        self._thread = None
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    # --- API pública ---
+
+    def publish(self, payload, topic=None):
+        """
+        Enfileira `payload` (dict ou str) e retorna um Future que resolve para True
+        quando o broker confirmar (PUBACK). O prazo de `ack_timeout` conta a partir
+        daqui; cancelar o Future antes do envio descarta a mensagem.
+        """
+        future = Future()
+        deadline = time.monotonic() + self.ack_timeout
+        body = payload if isinstance(payload, (str, bytes)) else json.dumps(payload)
+        with self._lock:
+            self._outstanding += 1
+        try:
+            self._outbox.put_nowait((topic or self.topic, body, future, deadline))
+        except queue.Full:
+            self._resolve(future, error=RuntimeError("Fila de saída MQTT cheia"))
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Bloqueia até que todas as mensagens enfileiradas tenham sido confirmadas
+        ou falhado. Retorna False se o tempo acabar antes disso.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._outstanding > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pendentes"] = self._outstanding
+        stats["conectado"] = self.is_connected()
+        return stats
+
+    # --- Internos ---
+
+    def _resolve(self, future, error=None):
+        try:
+            if error is None:
+                future.set_result(True)
+            else:
+                future.set_exception(error)
+        except InvalidStateError:
+            pass  # Já cancelado pelo chamador
+        with self._idle:
+            if error is None:
+                self._stats["confirmadas"] += 1
+            else:
+                self._stats["falhas"] += 1
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._idle.notify_all()
+
+    def _drain_loop(self):
+        while not self._stopping.is_set():
+            self._expire_pending()
+            try:
+                topic, body, future, deadline = self._outbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            # Segura a mensagem até a sessão estar de pé, sem passar do prazo
+            expired = self._expired(future, deadline)
+            while not expired and not self._connected.wait(0.5):
+                self._expire_pending()
+                if self._stopping.is_set():
+                    self._resolve(future, error=RuntimeError("Publicador MQTT encerrado"))
+                    return
+                expired = self._expired(future, deadline)
+            if expired:
+                self._resolve(future, error=TimeoutError("Mensagem expirou na fila de saída"))
+                continue
+
+            try:
+                # O publish do paho não pode rodar com self._lock: a thread de rede
+                # segura o lock interno do paho enquanto chama _on_publish, que
+                # precisa de self._lock (inversão de ordem -> deadlock sob carga).
+                info = self._client.publish(topic, body, qos=1)
+                if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                    self._resolve(future, error=RuntimeError(mqtt.error_string(info.rc)))
+                    continue
+                with self._lock:
+                    self._stats["enviadas"] += 1
+                    early = self._early_acks.pop(info.mid, None)
+                    # Só há um publish por vez: o que sobrar é PUBACK atrasado de mensagem expirada
+                    self._early_acks.clear()
+                    if early is None:
+                        self._pending[info.mid] = (future, deadline)
+                        continue
+                self._ack(future, early)
+            except Exception as e:
+                logger.exception("Erro ao publicar no MQTT")
+                self._resolve(future, error=e)
+
+    @staticmethod
+    def _expired(future, deadline):
+        return future.cancelled() or time.monotonic() > deadline
+
+    def _expire_pending(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [mid for mid, (_, deadline) in self._pending.items() if now > deadline]
+            futures = [self._pending.pop(mid)[0] for mid in expired]
+        for future in futures:
+            self._resolve(future, error=TimeoutError("PUBACK não recebido a tempo"))
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error("Falha ao conectar no MQTT", extra={"reason": str(reason_code)})
+            return
+        logger.info("Conectado ao broker MQTT", extra={"host": self.host})
+        self._connected.set()
+
+    def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        self._connected.clear()
+        if not self._stopping.is_set():
+            with self._lock:
+                self._stats["reconexoes"] += 1
+            logger.warning("Conexão MQTT perdida; reconectando", extra={"reason": str(reason_code)})
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self._lock:
+            entry = self._pending.pop(mid, None)
+            if entry is None:
+                # O PUBACK chegou antes de _drain_loop registrar o mid
+                self._early_acks[mid] = reason_code
+                return
+        self._ack(entry[0], reason_code)
+
+    def _ack(self, future, reason_code):
+        if reason_code.is_failure:
+            self._resolve(future, error=RuntimeError(f"PUBACK com falha: {reason_code}"))
+        else:
+            self._resolve(future)
+
+
+if __name__ == '__main__':
+    # Medição rápida de vazão contra um broker local, ex.: `mosquitto -p 1883`
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Mede a vazão do publicador MQTT (msg/s)")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--tls", action="store_true")
+    parser.add_argument("--topic", default="capsulatempo/bench")
+    parser.add_argument("--count", type=int, default=1000)
+    args = parser.parse_args()
+
+    publisher = MqttPublisher(args.host, args.port, topic=args.topic, tls=args.tls)
+    publisher.start()
+    if not publisher._connected.wait(10):
+        raise SystemExit("Não foi possível conectar ao broker")
+
+    start = time.perf_counter()
+    futures = [publisher.publish({"capsula": {"id": str(i)}}) for i in range(args.count)]
+    publisher.flush()
+    elapsed = time.perf_counter() - start
+    ok = sum(1 for f in futures if f.exception() is None)
+    print(f"{ok}/{args.count} mensagens confirmadas em {elapsed:.3f}s "
+          f"({ok / elapsed:.1f} msg/s)")
+    publisher.stop()
@@ -0,0 +1,156 @@
+# Índice de liberação em memória (heap de timers) para as cápsulas
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def parse_release_date(value):
+    """
+    Converte o `release_date` vindo do Supabase em datetime local "naive",
+    que é como as datas de liberação são gravadas e comparadas no projeto.
+    """
+    if isinstance(value, datetime):
+        release = value
+    else:
+        release = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if release.tzinfo is not None:
+        release = release.astimezone().replace(tzinfo=None)
+    return release
+
+
+class ReleaseScheduler:
+    """
+    Min-heap de cápsulas ordenado por `release_date`.
+
+    Uma thread dorme exatamente até a próxima liberação e entrega todas as
+    cápsulas vencidas naquele instante, em um único lote, para `on_due(lote)`.
+    `on_due` retorna os IDs entregues com sucesso; os demais saem do índice e
+    voltam na próxima reconciliação (`load`). Só são mantidas cápsulas dentro
+    da janela de antecedência (`lookahead`), para limitar o uso de memória.
+    """
+
+    # Teto para o sono da thread, protege contra ajustes no relógio do sistema
+    MAX_SLEEP = 60.0
+
+    def __init__(self, on_due, lookahead=timedelta(minutes=15)):
+        self.on_due = on_due
+        self.lookahead = lookahead
+        self._heap = []
+        self._seq = itertools.count()
+        self._scheduled = set()
+        self._firing = set()
+        self._delivered = {}  # id -> instante da entrega (evita republicar após reconciliação)
+        self._horizon = datetime.now() + lookahead
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    # --- Ciclo de vida ---
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="release-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    # --- API pública ---
+
+    def add(self, capsule):
+        """ Indexa uma cápsula (dict com ao menos `id` e `release_date`). """
+        return self.add_many([capsule])
+
+    def add_many(self, capsules):
+        """ Indexa várias cápsulas de uma vez. Retorna quantas foram adicionadas. """
+        added = 0
+        with self._cond:
+            earliest = self._heap[0][0] if self._heap else None
+            for capsule in capsules:
+                capsule_id = capsule['id']
+                if (capsule_id in self._scheduled or capsule_id in self._firing
+                        or capsule_id in self._delivered):
+                    continue
+                release = parse_release_date(capsule['release_date'])
+                if release > self._horizon:
+                    continue
+                heapq.heappush(self._heap, (release, next(self._seq), capsule))
+                self._scheduled.add(capsule_id)
+                added += 1
+            # Só acorda a thread se a próxima liberação ficou mais cedo
+            if added and (earliest is None or self._heap[0][0] < earliest):
+                self._cond.notify_all()
+        return added
+
+    def load(self, capsules, horizon=None):
+        """
+        Reconciliação: estende a janela até `horizon` e indexa as cápsulas
+        pendentes lidas do banco (as já indexadas são ignoradas).
+        """
+        with self._cond:
+            self._horizon = horizon or datetime.now() + self.lookahead
+            self._prune_delivered()
+        return self.add_many(capsules)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "agendadas": len(self._heap),
+                "em_processamento": len(self._firing),
+                "proxima_liberacao": self._heap[0][0].isoformat() if self._heap else None,
+                "horizonte": self._horizon.isoformat()
+            }
+
+    # --- Internos ---
+
+    def _prune_delivered(self):
+        cutoff = time.monotonic() - 2 * self.lookahead.total_seconds()
+        for capsule_id in [cid for cid, at in self._delivered.items() if at < cutoff]:
+            del self._delivered[capsule_id]
+
+    def _next_batch(self):
+        """ Espera até haver cápsulas vencidas e as retira do heap. """
+        with self._cond:
+            while not self._stopping:
+                now = datetime.now()
+                if self._heap and self._heap[0][0] <= now:
+                    batch = []
+                    while self._heap and self._heap[0][0] <= now:
+                        capsule = heapq.heappop(self._heap)[2]
+                        self._scheduled.discard(capsule['id'])
+                        self._firing.add(capsule['id'])
+                        batch.append(capsule)
+                    return batch
+                timeout = self.MAX_SLEEP
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                self._cond.wait(timeout)
+            return None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            delivered = ()
+            try:
+                delivered = self.on_due(batch) or ()
+            except Exception:
+                logger.exception("Erro ao processar lote de liberação", extra={"count": len(batch)})
+            with self._cond:
+                now = time.monotonic()
+                for capsule_id in delivered:
+                    self._delivered[capsule_id] = now
+                for capsule in batch:
+                    self._firing.discard(capsule['id'])
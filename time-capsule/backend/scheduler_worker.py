@@ -0,0 +1,66 @@
+# Processo dedicado à liberação das cápsulas físicas, separado dos workers web
+#
+# Uso:
+#   SCHEDULER_MODE=off gunicorn app:app -w 4     # web: não libera nada
+#   python scheduler_worker.py                   # um ou mais processos de liberação
+#
+# Por padrão roda no modo `claim` (sql/claim_due_capsules.sql), então é seguro
+# subir vários processos deste, em uma ou mais máquinas: cada cápsula é
+# publicada uma única vez. `--mode embedded` dispensa a função SQL, mas só pode
+# haver um processo liberando cápsulas.
+import argparse
+import os
+import signal
+import threading
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port):
+    """ Expõe /metrics (formato Prometheus) deste processo em uma thread. """
+    from metrics import REGISTRY
+
+    def application(environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found']
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+        return [REGISTRY.render().encode()]
+
+    server = make_server('0.0.0.0', port, application, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agendador de liberações das cápsulas físicas")
+    parser.add_argument('--mode', choices=('claim', 'embedded'), default='claim')
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('SCHEDULER_METRICS_PORT', 0)),
+                        help="Porta para expor /metrics (0 desativa)")
+    args = parser.parse_args()
+
+    # Precisa valer antes de importar o app, que inicia o agendador na importação
+    os.environ['SCHEDULER_MODE'] = args.mode
+    import app as backend
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    backend.logger.info("Processo de liberação pronto",
+                        extra={"mode": args.mode, "worker": backend.scheduler_worker_id()})
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    stop.wait()
+
+    # A sessão MQTT é drenada e fechada pelo atexit registrado no app
+    backend.scheduler.shutdown(wait=False)
+    backend.release_scheduler.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# Índice espacial (grade de células lat/lng) para buscar cápsulas próximas
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """ Distância (km) de um ponto a um vetor de pontos, vetorizada com NumPy. """
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class _Bucket:
+    __slots__ = ("lats", "lngs", "capsules")
+
+    def __init__(self):
+        self.lats = []
+        self.lngs = []
+        self.capsules = []
+
+
+class _Load:
+    __slots__ = ("event", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+
+class _UserIndex:
+    __slots__ = ("buckets", "ids", "loaded_at")
+
+    def __init__(self):
+        self.buckets = {}
+        self.ids = set()
+        self.loaded_at = time.monotonic()
+
+
+class SpatialIndex:
+    """
+    Índice por usuário das cápsulas com localização, dividido em células de
+    `cell_deg` graus. Uma busca só visita as células que cobrem o raio pedido
+    e refina os candidatos com haversine vetorizado, de modo que o custo depende
+    da densidade local, não do total de cápsulas do usuário.
+
+    Cada usuário é carregado sob demanda e recarregado após `ttl` segundos,
+    o que cobre cápsulas criadas por outros processos. No máximo `max_users`
+    usuários ficam em memória; o usado há mais tempo é descartado.
+    """
+
+    def __init__(self, cell_deg=0.01, ttl=300, max_users=1000):
+        self.cell_deg = cell_deg
+        self.ttl = ttl
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._loading = {}  # user_id -> _Load em andamento
+        self._lock = threading.Lock()
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def _insert(self, user_index, capsule):
+        if capsule['id'] in user_index.ids:
+            return
+        lat, lng = float(capsule['lat']), float(capsule['lng'])
+        bucket = user_index.buckets.setdefault(self._cell(lat, lng), _Bucket())
+        bucket.lats.append(lat)
+        bucket.lngs.append(lng)
+        bucket.capsules.append(capsule)
+        user_index.ids.add(capsule['id'])
+
+    def load_user(self, user_id, capsules):
+        """ Substitui o índice do usuário pelas cápsulas informadas. """
+        user_index = _UserIndex()
+        for capsule in capsules:
+            if capsule.get('lat') is not None and capsule.get('lng') is not None:
+                self._insert(user_index, capsule)
+        with self._lock:
+            self._users[user_id] = user_index
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def ensure_user(self, user_id, loader):
+        """
+        Garante o usuário no índice, chamando `loader()` (lista de cápsulas) se
+        ele não estiver carregado ou tiver expirado. Cargas simultâneas do mesmo
+        usuário são coalescidas: só uma thread consulta o banco. Durante a
+        recarga de um índice expirado, as demais buscas usam o índice anterior.
+        """
+        with self._lock:
+            user_index = self._users.get(user_id)
+            if user_index is not None and time.monotonic() - user_index.loaded_at < self.ttl:
+                return
+            load = self._loading.get(user_id)
+            leader = load is None
+            if leader:
+                load = self._loading[user_id] = _Load()
+
+        if not leader:
+            if user_index is None:
+                load.event.wait()
+                if load.error is not None:
+                    raise load.error
+            return
+
+        try:
+            self.load_user(user_id, loader())
+        except Exception as e:
+            load.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loading[user_id]
+            load.event.set()
+
+    def add(self, user_id, capsule):
+        """ Atualização incremental; usuários ainda não carregados são ignorados. """
+        if capsule.get('lat') is None or capsule.get('lng') is None:
+            return
+        with self._lock:
+            user_index = self._users.get(user_id)
+            if user_index is not None:
+                self._insert(user_index, capsule)
+
+    def query(self, user_id, lat, lng, radius_m):
+        """ Retorna [(cápsula, distância em metros)] dentro do raio, da mais próxima à mais distante. """
+        radius_km = radius_m / 1000.0
+        dlat = radius_km / KM_PER_DEGREE
+        dlng = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        min_cell = self._cell(lat - dlat, lng - dlng)
+        max_cell = self._cell(lat + dlat, lng + dlng)
+
+        lats, lngs, candidates = [], [], []
+        with self._lock:
+            user_index = self._users.get(user_id)
+            if user_index is None:
+                return []
+            self._users.move_to_end(user_id)
+            buckets = user_index.buckets
+            n_cells = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+            if n_cells > len(buckets):
+                keys = [k for k in buckets
+                        if min_cell[0] <= k[0] <= max_cell[0] and min_cell[1] <= k[1] <= max_cell[1]]
+            else:
+                keys = [(i, j) for i in range(min_cell[0], max_cell[0] + 1)
+                        for j in range(min_cell[1], max_cell[1] + 1) if (i, j) in buckets]
+            for key in keys:
+                bucket = buckets[key]
+                lats.extend(bucket.lats)
+                lngs.extend(bucket.lngs)
+                candidates.extend(bucket.capsules)
+
+        if not candidates:
+            return []
+        distances = haversine_km(lat, lng, np.asarray(lats), np.asarray(lngs)) * 1000.0
+        inside = np.flatnonzero(distances <= radius_m)
+        inside = inside[np.argsort(distances[inside], kind='stable')]
+        return [(candidates[i], float(distances[i])) for i in inside]
@@ -0,0 +1,27 @@
+-- Criação em lote de cápsulas (usada por POST /capsules/bulk).
+-- Cada chamada roda em uma única transação: ou o bloco inteiro é gravado, ou nada.
+--
+-- p_rows: [{"capsule": {...colunas de capsules...}, "media": [{"storage_path": ..., "media_type": ...}]}]
+-- Retorna as cápsulas criadas, na mesma ordem da entrada.
+create or replace function public.bulk_create_capsules(p_rows jsonb)
+returns setof public.capsules
+language plpgsql
+as $$
+declare
+  r jsonb;
+  c public.capsules;
+begin
+  for r in select value from jsonb_array_elements(p_rows) loop
+    insert into public.capsules (message, release_date, lat, lng, user_id, tipo)
+    select message, release_date, lat, lng, user_id, tipo
+    from jsonb_populate_record(null::public.capsules, r->'capsule')
+    returning * into c;
+
+    insert into public.capsule_media (capsule_id, storage_path, media_type)
+    select c.id, m->>'storage_path', m->>'media_type'
+    from jsonb_array_elements(coalesce(r->'media', '[]'::jsonb)) as m;
+
+    return next c;
+  end loop;
+end;
+$$;
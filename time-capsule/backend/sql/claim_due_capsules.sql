@@ -0,0 +1,40 @@
+-- Posse temporária (lease) das cápsulas físicas vencidas, usada com SCHEDULER_MODE=claim.
+-- Vários processos podem chamar a função ao mesmo tempo: cada linha vencida é
+-- entregue a um único chamador (FOR UPDATE SKIP LOCKED) e fica reservada a ele
+-- até `claimed_until`. Se o processo morrer antes de marcá-la como notificada,
+-- a reserva expira e outro processo a reivindica.
+
+alter table public.capsules add column if not exists claimed_by text;
+alter table public.capsules add column if not exists claimed_until timestamptz;
+
+create index if not exists capsules_pending_physical_idx
+  on public.capsules (release_date)
+  where tipo = 'fisica' and notificacao_enviada = false;
+
+-- p_now: hora local "naive" do chamador (release_date é gravada assim).
+-- O prazo da reserva usa o relógio do banco, comum a todos os processos.
+create or replace function public.claim_due_capsules(
+  p_worker text,
+  p_now timestamp,
+  p_limit int default 500,
+  p_lease_seconds int default 120
+)
+returns setof public.capsules
+language sql
+as $$
+  update public.capsules c
+     set claimed_by = p_worker,
+         claimed_until = now() + make_interval(secs => p_lease_seconds)
+   where c.id in (
+     select id
+       from public.capsules
+      where tipo = 'fisica'
+        and notificacao_enviada = false
+        and release_date <= p_now
+        and (claimed_until is null or claimed_until < now())
+      order by release_date
+      limit p_limit
+      for update skip locked
+   )
+  returning c.*;
+$$;
@@ -0,0 +1,117 @@
+import { onMounted, onUnmounted } from 'vue'
+import axios from 'axios'
+import { useAuthStore } from '../stores/auth'
+
+// Eventos das cápsulas enviados pelo backend (SSE), em vez de consultar de novo:
+//   unlocked - a data de liberação chegou
+//   notified - a cápsula física foi sinalizada ao dispositivo IoT
+//   reset    - eventos foram perdidos; recarregue os dados
+// Uma única conexão por aba é compartilhada pelas telas abertas. O EventSource
+// não envia cabeçalhos, então a URL leva um token curto, só do stream, pedido
+// com o token de acesso (que nunca vai na URL nem nos logs do servidor).
+// O próprio EventSource reconecta e envia o Last-Event-ID; se o token já
+// expirou, a conexão fecha e abrimos outra com um token novo, retomando do
+// último ID recebido. Se o servidor não oferece eventos (501 no modo WSGI sem
+// EVENTS_WSGI=1), desistimos e as telas seguem só com a API.
+const EVENT_TYPES = ['unlocked', 'notified', 'reset']
+const CLOSE_DELAY_MS = 2000 // Mantém a conexão na troca de tela
+const REOPEN_DELAY_MS = 5000
+
+let source = null
+let sourceToken = null // Token de acesso do usuário da conexão atual
+let lastEventId = null
+let closeTimer = null
+let reopenTimer = null
+let opening = null // Token de acesso com um pedido de token de stream em andamento
+let unavailable = false
+const handlers = new Set()
+
+const requestStreamToken = async (accessToken) => {
+  const response = await axios.post(`${import.meta.env.VITE_API_URL}/capsules/events/token`, null, {
+    headers: { Authorization: `Bearer ${accessToken}` }
+  })
+  return response.data.token
+}
+
+const scheduleReopen = (accessToken) => {
+  clearTimeout(reopenTimer)
+  reopenTimer = setTimeout(() => {
+    if (handlers.size > 0 && sourceToken === accessToken) openSource(accessToken)
+  }, REOPEN_DELAY_MS)
+}
+
+const openSource = async (accessToken) => {
+  clearTimeout(closeTimer)
+  if (unavailable) return
+  if ((source || opening) && sourceToken === accessToken) return
+  if (sourceToken !== accessToken) {
+    closeSource()
+    lastEventId = null // Outro usuário: não retoma os eventos do anterior
+  }
+  sourceToken = accessToken
+
+  let streamToken
+  opening = accessToken
+  try {
+    streamToken = await requestStreamToken(accessToken)
+  } catch (err) {
+    if (err.response && err.response.status === 501) {
+      unavailable = true
+    } else if (!err.response || err.response.status >= 500) {
+      scheduleReopen(accessToken)
+    }
+    return
+  } finally {
+    opening = null
+  }
+  if (sourceToken !== accessToken || handlers.size === 0) return
+
+  const params = new URLSearchParams({ token: streamToken })
+  if (lastEventId) params.set('lastEventId', lastEventId)
+  const current = new EventSource(`${import.meta.env.VITE_API_URL}/capsules/events?${params}`)
+  source = current
+  current.addEventListener('ready', (message) => {
+    lastEventId = message.lastEventId || lastEventId
+  })
+  EVENT_TYPES.forEach((type) => {
+    current.addEventListener(type, (message) => {
+      lastEventId = message.lastEventId || lastEventId
+      const data = message.data ? JSON.parse(message.data) : {}
+      handlers.forEach((handler) => handler(type, data))
+    })
+  })
+  current.onerror = () => {
+    // CONNECTING: o navegador já está reconectando. CLOSED: o servidor recusou
+    // (ex.: token de stream expirado) e precisamos de um token novo.
+    if (current.readyState === EventSource.CLOSED && source === current) {
+      source = null
+      scheduleReopen(accessToken)
+    }
+  }
+}
+
+const closeSource = () => {
+  clearTimeout(reopenTimer)
+  if (source) {
+    source.close()
+    source = null
+  }
+  sourceToken = null
+}
+
+export function useCapsuleEvents(handler) {
+  const authStore = useAuthStore()
+
+  onMounted(() => {
+    if (!authStore.token) return
+    handlers.add(handler)
+    openSource(authStore.token)
+  })
+
+  onUnmounted(() => {
+    handlers.delete(handler)
+    if (handlers.size === 0) {
+      closeTimer = setTimeout(closeSource, CLOSE_DELAY_MS)
+    }
+  })
+}